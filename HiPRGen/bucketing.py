@@ -1,6 +1,19 @@
 from HiPRGen.mol_entry import MoleculeEntry
-from itertools import combinations_with_replacement
+from itertools import (
+    combinations_with_replacement,
+    islice,
+    repeat,
+    chain,
+    product
+)
+from bisect import bisect_left
+from operator import itemgetter
+from heapq import heappush, heappop
+from multiprocessing import Pool
+from math import isqrt
+import os
 import sqlite3
+import numpy as np
 
 """
 Phase 2: bucketing pairs of species input: filtered list of species
@@ -15,75 +28,163 @@ within reach
 
 
 
+def complex_rows(
+        mol_entries,
+        group_size,
+        group_counts,
+        composition_ids,
+        complex_counts):
+    """
+    yields the rows of the complexes table: first each species on its
+    own and then each pair of species. group_counts, composition_ids
+    and complex_counts are filled in as compositions are encountered.
+    """
+    bucket_counts = complex_counts
+
+    def row(species_1, species_2, species):
+        composition = '_'.join(sorted(species))
+
+        if composition not in group_counts:
+            group_counts[composition] = 0
+            bucket_counts[composition] = 0
+            composition_ids[composition] = len(composition_ids)
+
+        data = (
+            species_1,
+            species_2,
+            composition_ids[composition],
+            group_counts[composition])
+
+        bucket_counts[composition] += 1
+        if bucket_counts[composition] % group_size == 0:
+            group_counts[composition] += 1
+
+        return data
+
+    for m in mol_entries:
+        yield row(m.ind, -1, m.species)
+
+    for (m1, m2) in combinations_with_replacement(mol_entries, 2):
+        yield row(m1.ind, m2.ind, m1.species + m2.species)
+
+
+# PRAGMAs used while building the bucket database in bulk mode. The
+# journal and fsyncs are turned off, so if bucketing is interrupted the
+# database must be rebuilt from scratch.
+bulk_pragmas = [
+    "PRAGMA page_size = 65536",
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA cache_size = -1048576",
+    "PRAGMA temp_store = MEMORY"
+]
+
+
 def bucket(
         mol_entries,
         bucket_db,
         commit_freq=2000,
-        group_size=1000):
+        group_size=1000,
+        bulk=False,
+        chunk_size=100000,
+        vector_join=False,
+        target_batch_cost=None,
+        charge_groups=False,
+        skeleton_order=False):
+    """
+    if bulk is True, rows are inserted chunk_size at a time with
+    executemany, using the bulk_pragmas, and the composition index is
+    created once all the rows are in. The resulting tables are the same.
+
+    if vector_join is True, the rows come from vector_complex_rows
+    instead of complex_rows, which doesn't build a composition string
+    for every pair. The rows are inserted composition by composition,
+    but every group gets the same complexes in the same order.
+
+    if target_batch_cost is given, group_size is ignored and the work
+    batches are sized by cost instead (see work batches below).
+
+    if charge_groups is True, the complexes in each group all have the
+    same total charge, so that the dispatcher can skip pairs of groups
+    whose charges are too far apart (see charge groups below). This
+    always uses the vector join.
+
+    if skeleton_order is True, the complexes in each composition are
+    sorted by their covalent skeleton, so that complexes which only
+    differ in charge or spin end up in the same groups (see skeleton
+    order below). This also uses the vector join.
+    """
+
+    if target_batch_cost is not None:
+        group_size = cost_balanced_group_size(target_batch_cost)
 
     con = sqlite3.connect(bucket_db)
     cur = con.cursor()
+
+    if bulk:
+        for pragma in bulk_pragmas:
+            cur.execute(pragma)
+
     cur.execute(
         "CREATE TABLE complexes (species_1, species_2, composition_id, group_id)")
 
     # we create an index on (composition, group_id) so worker processes
     # during reaction filtering can read their work batch faster
-
-    cur.execute(
+    create_composition_index = (
         "CREATE INDEX composition_index ON complexes (composition_id, group_id)")
 
+    if not bulk:
+        cur.execute(create_composition_index)
+
     group_counts = {}
-    bucket_counts = {}
     composition_ids = {}
+    complex_counts = {}
+    group_layouts = {}
     commit_count = 0
-    composition_count = 0
 
-    for m in mol_entries:
-        composition = '_'.join(sorted(m.species))
-
-        if composition not in group_counts:
-            group_counts[composition] = 0
-            bucket_counts[composition] = 0
-            composition_ids[composition] = composition_count
-            composition_count += 1
+    if charge_groups or skeleton_order:
+        rows = sorted_complex_rows(
+            mol_entries,
+            group_size,
+            group_counts,
+            composition_ids,
+            complex_counts,
+            group_layouts,
+            charge_groups,
+            skeleton_order)
+    elif vector_join:
+        rows = vector_complex_rows(
+            mol_entries,
+            group_size,
+            group_counts,
+            composition_ids,
+            complex_counts)
+    else:
+        rows = complex_rows(
+            mol_entries,
+            group_size,
+            group_counts,
+            composition_ids,
+            complex_counts)
 
-        data = (m.ind, -1, composition_ids[composition], group_counts[composition])
-        cur.execute("INSERT INTO complexes VALUES (?, ?, ?, ?)", data)
+    if bulk:
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if len(chunk) == 0:
+                break
 
-        commit_count += 1
-        if commit_count % commit_freq == 0:
+            cur.executemany("INSERT INTO complexes VALUES (?, ?, ?, ?)", chunk)
             con.commit()
 
-        bucket_counts[composition] += 1
-        if bucket_counts[composition] % group_size == 0:
-            group_counts[composition] += 1
-
+        cur.execute(create_composition_index)
 
-    for (m1, m2) in combinations_with_replacement(mol_entries, 2):
-        composition = '_'.join(sorted(m1.species + m2.species))
-
-        if composition not in group_counts:
-            group_counts[composition] = 0
-            bucket_counts[composition] = 0
-            composition_ids[composition] = composition_count
-            composition_count += 1
-
-
-        data = (
-            m1.ind,
-            m2.ind,
-            composition_ids[composition],
-            group_counts[composition])
-
-        cur.execute("INSERT INTO complexes VALUES (?, ?, ?, ?)", data)
+    else:
+        for data in rows:
+            cur.execute("INSERT INTO complexes VALUES (?, ?, ?, ?)", data)
 
-        commit_count += 1
-        if commit_count % commit_freq == 0:
-            con.commit()
-
-        bucket_counts[composition] += 1
-        if bucket_counts[composition] % group_size == 0:
-            group_counts[composition] += 1
+            commit_count += 1
+            if commit_count % commit_freq == 0:
+                con.commit()
 
 
     con.execute("CREATE TABLE group_counts (composition_id, count)")
@@ -106,9 +207,1221 @@ def bucket(
             con.commit()
 
 
+    if charge_groups:
+        con.execute(
+            "CREATE TABLE group_charges (composition_id, group_id, charge)")
+        cur.executemany(
+            "INSERT INTO group_charges VALUES (?, ?, ?)",
+            [(composition_ids[composition], group_id, charge)
+             for composition, layout in group_layouts.items()
+             for group_id, (charge, _) in enumerate(layout)])
+
+    if target_batch_cost is not None:
+        composition_group_sizes = [None] * len(composition_ids)
+        for composition in composition_ids:
+            if charge_groups or skeleton_order:
+                sizes = [size for _, size in group_layouts[composition]]
+            else:
+                sizes = group_sizes(complex_counts[composition], group_size)
+
+            composition_group_sizes[composition_ids[composition]] = sizes
+
+        write_work_batches(
+            cur,
+            cost_balanced_work_batches(
+                composition_group_sizes,
+                target_batch_cost))
 
 
     con.commit()
     con.close()
 
 
+"""
+work batches:
+
+The dispatcher hands out (composition_id, group_id_0, group_id_1)
+triples, and the worker runs every ordered pair of complexes from the
+two groups through the decision tree, so a triple costs
+len(group_0) * len(group_1) candidate reactions, or
+len(group_0) * (len(group_0) - 1) if the groups are the same. With a
+fixed group size, small compositions give lots of triples which are
+almost all dispatch overhead, while two full groups give 10^6
+candidates.
+
+With a target_batch_cost, the group size is isqrt(target_batch_cost),
+so that triples from large compositions cost about target_batch_cost.
+Consecutive triples are then packed into work batches costing at most
+target_batch_cost, which coalesces the small compositions and the
+partial last groups. Triples which cost nothing (an empty group, or a
+group with one complex paired with itself) are dropped. The batches are
+stored in the work_batches table, one row for each triple, and the
+dispatcher hands out a whole work batch at a time.
+"""
+
+
+def cost_balanced_group_size(target_batch_cost):
+    return max(1, isqrt(target_batch_cost))
+
+
+def group_sizes(complex_count, group_size):
+    """
+    the number of complexes in each group of a composition. Like bucket,
+    there are complex_count // group_size + 1 groups.
+    """
+    return [
+        min(group_size, complex_count - group_id * group_size)
+        for group_id in range(complex_count // group_size + 1)]
+
+
+def triple_cost(sizes, group_id_0, group_id_1):
+    """
+    the number of candidate reactions a worker enumerates for the
+    triple (composition_id, group_id_0, group_id_1), where sizes are the
+    group sizes of the composition.
+    """
+    if group_id_0 == group_id_1:
+        return sizes[group_id_0] * (sizes[group_id_0] - 1)
+    else:
+        return sizes[group_id_0] * sizes[group_id_1]
+
+
+def cost_balanced_work_batches(composition_group_sizes, target_batch_cost):
+    """
+    composition_group_sizes is the list of group sizes for each
+    composition, by composition id. returns a list of work batches, each
+    a list of triples.
+    """
+    work_batches = []
+    work_batch = []
+    work_batch_cost = 0
+
+    for composition_id, sizes in enumerate(composition_group_sizes):
+        for group_id_0 in range(len(sizes)):
+            for group_id_1 in range(len(sizes)):
+                cost = triple_cost(sizes, group_id_0, group_id_1)
+                if cost == 0:
+                    continue
+
+                if (len(work_batch) > 0 and
+                    work_batch_cost + cost > target_batch_cost):
+                    work_batches.append(work_batch)
+                    work_batch = []
+                    work_batch_cost = 0
+
+                work_batch.append((composition_id, group_id_0, group_id_1))
+                work_batch_cost += cost
+
+    if len(work_batch) > 0:
+        work_batches.append(work_batch)
+
+    return work_batches
+
+
+def write_work_batches(cur, work_batches):
+    cur.execute(
+        "CREATE TABLE work_batches "
+        "(batch_id, composition_id, group_id_0, group_id_1)")
+
+    cur.executemany(
+        "INSERT INTO work_batches VALUES (?, ?, ?, ?)",
+        [(batch_id, composition_id, group_id_0, group_id_1)
+         for batch_id, work_batch in enumerate(work_batches)
+         for (composition_id, group_id_0, group_id_1) in work_batch])
+
+
+def table_names(con):
+    return [row[0] for row in con.execute(
+        "SELECT name FROM sqlite_master WHERE type='table'")]
+
+
+def load_work_batches(con, max_charge_difference=None):
+    """
+    the work batches for the bucket database con, each a list of
+    (composition_id, group_id_0, group_id_1) triples. If there is no
+    work_batches table, every pair of groups from a composition is its
+    own work batch.
+
+    if max_charge_difference is given, triples where the charges of the
+    two groups differ by more than max_charge_difference are left out.
+    This needs a bucket database written with charge groups.
+    """
+    work_batches = []
+
+    if 'work_batches' in table_names(con):
+        batch_ids = {}
+        for (batch_id, composition_id, group_id_0, group_id_1) in con.execute(
+                "SELECT * FROM work_batches"):
+
+            if batch_id not in batch_ids:
+                batch_ids[batch_id] = len(work_batches)
+                work_batches.append([])
+
+            work_batches[batch_ids[batch_id]].append(
+                (composition_id, group_id_0, group_id_1))
+
+    else:
+        for (composition_id, count) in con.execute(
+                "SELECT * FROM group_counts"):
+            for (i, j) in product(range(count), repeat=2):
+                work_batches.append([(composition_id, i, j)])
+
+    if max_charge_difference is not None:
+        if 'group_charges' not in table_names(con):
+            raise Exception(
+                "max_charge_difference needs a bucket database "
+                "with charge groups")
+
+        group_charges = {
+            (composition_id, group_id): charge
+            for composition_id, group_id, charge in con.execute(
+                    "SELECT * FROM group_charges")}
+
+        pruned_work_batches = []
+        for work_batch in work_batches:
+            work_batch = [
+                (composition_id, group_id_0, group_id_1)
+                for composition_id, group_id_0, group_id_1 in work_batch
+                if abs(group_charges[composition_id, group_id_1] -
+                       group_charges[composition_id, group_id_0]) <=
+                max_charge_difference]
+
+            if len(work_batch) > 0:
+                pruned_work_batches.append(work_batch)
+
+        work_batches = pruned_work_batches
+
+    return work_batches
+
+
+"""
+charge groups:
+
+A candidate reaction turns the complex from group_id_0 into the complex
+from group_id_1, so its change in charge is the difference of their
+total charges. The reaction decision trees discard redox reactions
+where the charge changes by more than one (dcharge_too_large), but
+with groups of mixed charge, the workers still have to enumerate those
+reactions and run them through the tree.
+
+bucket(..., charge_groups=True) orders the complexes of each
+composition by total charge and then splits them into groups, starting
+a new group whenever the charge changes or the group is full. The
+charge of each group is stored in the group_charges table, so the
+dispatcher can drop a whole triple if the charges of its two groups are
+more than max_charge_difference apart. With target_batch_cost, triples
+are packed using the actual group sizes. The packing doesn't know
+about max_charge_difference, so batches with pruned triples come out
+cheaper than the target.
+"""
+
+
+"""
+skeleton order:
+
+The structural reaction questions (the ones with structure_only set,
+see HiPRGen.structural_memo) only look at the covalent structure of the
+species, so their answers are the same for every charge and spin
+variant of the reactants and products. bucket(..., skeleton_order=True)
+sorts the complexes of each composition by their multiset of
+covalent_hash values, so the variants of a complex are next to each
+other and land in the same groups. A worker with a structural memo then
+evaluates the structural questions once for each pair of skeletons in a
+work batch. With charge groups, complexes are sorted by charge first and
+by skeleton within each charge.
+"""
+
+
+def split_groups(species_1, species_2, group_size, charges=None, skeletons=None):
+    """
+    sorts the complexes of a composition by total charge if charges is
+    given and by skeleton if skeletons is given, keeping their order
+    otherwise, and splits them into groups of at most group_size. If
+    charges is given, a new group also starts whenever the charge
+    changes. returns the sorted species_1 and species_2, the group id of
+    each complex and the (charge, size) of each group. The charge is
+    None if charges isn't given.
+    """
+    sort_keys = [() for _ in species_1]
+
+    if charges is not None:
+        complex_charges = [
+            charges[a] + (charges[b] if b != -1 else 0)
+            for a, b in zip(species_1, species_2)]
+
+        sort_keys = [(charge,) for charge in complex_charges]
+    else:
+        complex_charges = [None] * len(species_1)
+
+    if skeletons is not None:
+        sort_keys = [
+            sort_key + (tuple(sorted(
+                [skeletons[a]] + ([skeletons[b]] if b != -1 else []))),)
+            for sort_key, a, b in zip(sort_keys, species_1, species_2)]
+
+    order = sorted(range(len(sort_keys)), key=sort_keys.__getitem__)
+
+    group_ids = []
+    layout = []
+    for position in order:
+        charge = complex_charges[position]
+        if (len(layout) == 0 or
+            layout[-1][0] != charge or
+            layout[-1][1] == group_size):
+            layout.append((charge, 0))
+
+        layout[-1] = (charge, layout[-1][1] + 1)
+        group_ids.append(len(layout) - 1)
+
+    return (
+        [species_1[position] for position in order],
+        [species_2[position] for position in order],
+        group_ids,
+        layout)
+
+
+"""
+composition vectors:
+
+Rather than building the composition string of every pair of species,
+we can encode the element counts of each species as a vector once and
+group the species into classes with the same vector. The compositions,
+and the number of complexes in each, then come from joining the classes
+(a composition vector is the sum of two class vectors), and each
+composition expands into its species pairs afterwards.
+
+Vectors are packed into ints with a fixed width field for each element,
+so adding vectors is adding ints. The top bit of each field is a guard
+bit which is never set in a valid vector. It catches borrows when
+subtracting vectors.
+
+Within a composition, complexes are expanded in the order which bucket
+inserts them: single species first and then pairs (a, b) with a <= b in
+lexicographic order. Since groups are consecutive runs of group_size
+complexes, the groups come out with the same contents either way.
+"""
+
+
+def composition_vector(species, element_ids):
+    vector = [0] * len(element_ids)
+    for element in species:
+        vector[element_ids[element]] += 1
+
+    return tuple(vector)
+
+
+class CompositionVectors:
+    """
+    species grouped into classes by composition vector. elements must be
+    sorted, so that composition strings agree with
+    '_'.join(sorted(species)).
+    """
+
+    def __init__(self, elements, species_vectors):
+        self.elements = elements
+        self.element_ids = {e: i for i, e in enumerate(elements)}
+
+        # enough bits for the element counts of a pair of species plus
+        # the guard bit
+        max_count = max([0] + [max(v, default=0) for _, v in species_vectors])
+        self.field_width = (2 * max_count).bit_length() + 1
+        self.field_mask = (1 << (self.field_width - 1)) - 1
+        self.guards = 0
+        for i in range(len(elements)):
+            self.guards |= 1 << (i * self.field_width + self.field_width - 1)
+
+        self.classes = {}
+        for species_id, vector in species_vectors:
+            key = self.pack(vector)
+            if key not in self.classes:
+                self.classes[key] = []
+
+            self.classes[key].append(species_id)
+
+        for species_ids in self.classes.values():
+            species_ids.sort()
+
+    @classmethod
+    def from_mol_entries(cls, mol_entries):
+        return cls.from_species([(m.ind, m.species) for m in mol_entries])
+
+    @classmethod
+    def from_species(cls, species):
+        """
+        species is a list of (species_id, list of elements)
+        """
+        elements = sorted(set([e for _, s in species for e in s]))
+        element_ids = {e: i for i, e in enumerate(elements)}
+        return cls(
+            elements,
+            [(species_id, composition_vector(s, element_ids))
+             for species_id, s in species])
+
+    def pack(self, vector):
+        key = 0
+        for i, count in enumerate(vector):
+            key |= count << (i * self.field_width)
+
+        return key
+
+    def unpack(self, key):
+        return tuple(
+            (key >> (i * self.field_width)) & self.field_mask
+            for i in range(len(self.elements)))
+
+    def composition(self, key):
+        return '_'.join(
+            [element
+             for i, element in enumerate(self.elements)
+             for _ in range((key >> (i * self.field_width)) & self.field_mask)])
+
+    def key_from_composition(self, composition):
+        return self.pack(
+            composition_vector(composition.split('_'), self.element_ids))
+
+    def complement(self, target, key):
+        """
+        target - key, or None if some element count goes negative.
+        """
+        difference = (target | self.guards) - key
+        if difference & self.guards != self.guards:
+            return None
+
+        return difference ^ self.guards
+
+    def join(self):
+        """
+        returns the composition keys in the order which bucket assigns
+        composition ids, the number of complexes for each, and for each
+        the pairs of classes which its pairs of species come from.
+        """
+        # bucket assigns composition ids in the order that compositions
+        # first appear. Single species come first. If the classes are
+        # sorted by their first species, the first pairs (a, b) of the
+        # class pairs (x, y) with x <= y are visited in increasing order,
+        # so compositions are also first seen in bucket's order.
+        class_list = sorted(
+            self.classes.items(),
+            key=lambda item: item[1][0])
+
+        keys = []
+        complex_counts = {}
+        pair_classes = {}
+
+        for key, species_ids in class_list:
+            keys.append(key)
+            complex_counts[key] = len(species_ids)
+            pair_classes[key] = []
+
+        class_sizes = [len(species_ids) for _, species_ids in class_list]
+        class_keys = [key for key, _ in class_list]
+
+        for x, key_0 in enumerate(class_keys):
+            size_0 = class_sizes[x]
+
+            for y in range(x, len(class_keys)):
+                key_1 = class_keys[y]
+                key = key_0 + key_1
+
+                if x == y:
+                    count = size_0 * (size_0 + 1) // 2
+                else:
+                    count = size_0 * class_sizes[y]
+
+                if key in complex_counts:
+                    complex_counts[key] += count
+                    pair_classes[key].append((key_0, key_1))
+                else:
+                    keys.append(key)
+                    complex_counts[key] = count
+                    pair_classes[key] = [(key_0, key_1)]
+
+        return keys, complex_counts, pair_classes
+
+    def complexes(self, target, class_pairs=None):
+        """
+        returns the single species with composition target and, for each
+        species a which is the first species of a pair, the sorted
+        partners of a and the index of the first partner >= a. If
+        class_pairs is None, the pairs of classes adding up to target
+        are found by searching all the classes.
+        """
+        if class_pairs is None:
+            class_pairs = []
+            for key in self.classes:
+                complement = self.complement(target, key)
+                if (complement is not None and
+                    complement in self.classes and
+                    key <= complement):
+                    class_pairs.append((key, complement))
+
+        pairs = []
+        for key_0, key_1 in class_pairs:
+            species_ids_0 = self.classes[key_0]
+
+            if key_0 == key_1:
+                for start, species_id in enumerate(species_ids_0):
+                    pairs.append((species_id, species_ids_0, start))
+
+            else:
+                species_ids_1 = self.classes[key_1]
+                for species_ids, partners in [
+                        (species_ids_0, species_ids_1),
+                        (species_ids_1, species_ids_0)]:
+
+                    for species_id in species_ids:
+                        start = bisect_left(partners, species_id)
+                        if start < len(partners):
+                            pairs.append((species_id, partners, start))
+
+        pairs.sort(key=itemgetter(0))
+        return self.classes.get(target, []), pairs
+
+
+def composition_complexes(vectors, key, class_pairs):
+    """
+    the species_1 and species_2 columns of the complexes with
+    composition key, in bucket order.
+    """
+    singles, pairs = vectors.complexes(key, class_pairs)
+
+    species_1 = list(singles)
+    species_2 = [-1] * len(singles)
+    for species_id, partners, start in pairs:
+        species_1.extend([species_id] * (len(partners) - start))
+        species_2.extend(partners[start:])
+
+    return species_1, species_2
+
+
+def composition_rows(vectors, key, composition_id, class_pairs, group_size):
+    """
+    the rows of the complexes table for one composition.
+    """
+    species_1, species_2 = composition_complexes(vectors, key, class_pairs)
+
+    count = len(species_1)
+    return zip(
+        species_1,
+        species_2,
+        repeat(composition_id, count),
+        [position // group_size for position in range(count)])
+
+
+def vector_complex_rows(
+        mol_entries,
+        group_size,
+        group_counts,
+        composition_ids,
+        complex_counts):
+    """
+    yields the same rows as complex_rows, grouped by composition.
+    """
+    vectors = CompositionVectors.from_mol_entries(mol_entries)
+    keys, key_complex_counts, pair_classes = vectors.join()
+
+    for composition_id, key in enumerate(keys):
+        composition = vectors.composition(key)
+        composition_ids[composition] = composition_id
+        complex_counts[composition] = key_complex_counts[key]
+        group_counts[composition] = key_complex_counts[key] // group_size
+
+    for composition_id, key in enumerate(keys):
+        yield from composition_rows(
+            vectors,
+            key,
+            composition_id,
+            pair_classes[key],
+            group_size)
+
+
+def sorted_complex_rows(
+        mol_entries,
+        group_size,
+        group_counts,
+        composition_ids,
+        complex_counts,
+        group_layouts,
+        charge_groups,
+        skeleton_order):
+    """
+    yields the rows of the complexes table with charge groups and/or
+    skeleton order, grouped by composition. group_layouts gets the
+    (charge, size) of each group.
+    """
+    charges = None
+    if charge_groups:
+        charges = {m.ind: m.charge for m in mol_entries}
+
+    skeletons = None
+    if skeleton_order:
+        skeletons = {m.ind: m.covalent_hash for m in mol_entries}
+
+    vectors = CompositionVectors.from_mol_entries(mol_entries)
+    keys, _, pair_classes = vectors.join()
+
+    for composition_id, key in enumerate(keys):
+        species_1, species_2 = composition_complexes(
+            vectors, key, pair_classes[key])
+
+        species_1, species_2, group_ids, layout = split_groups(
+            species_1, species_2, group_size, charges, skeletons)
+
+        composition = vectors.composition(key)
+        composition_ids[composition] = composition_id
+        complex_counts[composition] = len(species_1)
+        group_layouts[composition] = layout
+
+        # bucket writes group_counts[composition] + 1 groups
+        group_counts[composition] = len(layout) - 1
+
+        yield from zip(
+            species_1,
+            species_2,
+            repeat(composition_id, len(species_1)),
+            group_ids)
+
+
+"""
+virtual buckets:
+
+The complexes table has a row for every pair of species, so it grows
+quadratically with the number of species. virtual_bucket writes the
+same group_counts and compositions tables, but instead of the complexes
+it only stores the composition vector of each species. Workers expand
+the complexes in a group from the vectors.
+
+GroupLoader and VirtualGroupLoader load a group from either format, and
+group_loader picks the right one for a bucket database.
+"""
+
+get_complex_group_sql = """
+    SELECT * FROM complexes WHERE composition_id=? AND group_id=?
+"""
+
+
+def virtual_bucket(
+        mol_entries,
+        bucket_db,
+        group_size=1000,
+        target_batch_cost=None):
+    """
+    write a virtual bucket database (see above). target_batch_cost is
+    the same as for bucket.
+    """
+
+    if target_batch_cost is not None:
+        group_size = cost_balanced_group_size(target_batch_cost)
+
+    vectors = CompositionVectors.from_mol_entries(mol_entries)
+    keys, complex_counts, _ = vectors.join()
+
+    con = sqlite3.connect(bucket_db)
+    cur = con.cursor()
+    cur.execute("CREATE TABLE bucket_format (format, group_size)")
+    cur.execute("CREATE TABLE elements (element_id, element)")
+    cur.execute("CREATE TABLE species_vectors (species_id, vector)")
+    cur.execute("CREATE TABLE group_counts (composition_id, count)")
+    cur.execute("CREATE TABLE compositions (composition_id, composition)")
+
+    cur.execute(
+        "INSERT INTO bucket_format VALUES (?, ?)",
+        ('virtual', group_size))
+
+    cur.executemany(
+        "INSERT INTO elements VALUES (?, ?)",
+        list(enumerate(vectors.elements)))
+
+    cur.executemany(
+        "INSERT INTO species_vectors VALUES (?, ?)",
+        [(species_id, ','.join([str(n) for n in vectors.unpack(key)]))
+         for key, species_ids in vectors.classes.items()
+         for species_id in species_ids])
+
+    # bucket starts a new group after every group_size complexes, even
+    # if there are no more complexes coming.
+    cur.executemany(
+        "INSERT INTO group_counts VALUES (?, ?)",
+        [(composition_id, complex_counts[key] // group_size + 1)
+         for composition_id, key in enumerate(keys)])
+
+    cur.executemany(
+        "INSERT INTO compositions VALUES (?, ?)",
+        [(composition_id, vectors.composition(key))
+         for composition_id, key in enumerate(keys)])
+
+    if target_batch_cost is not None:
+        write_work_batches(
+            cur,
+            cost_balanced_work_batches(
+                [group_sizes(complex_counts[key], group_size) for key in keys],
+                target_batch_cost))
+
+    con.commit()
+    con.close()
+
+
+class GroupLoader:
+    """
+    loads groups of complexes from the complexes table.
+    """
+    def __init__(self, con):
+        self.cur = con.cursor()
+
+    def load(self, composition_id, group_id):
+        res = self.cur.execute(
+            get_complex_group_sql,
+            (composition_id, group_id))
+
+        return [(row[0], row[1]) for row in res]
+
+    def group_sizes(self, composition_id, count):
+        """
+        the number of complexes in each of the count groups of
+        composition_id.
+        """
+        sizes = [0] * count
+        for group_id, size in self.cur.execute(
+                "SELECT group_id, count(*) FROM complexes "
+                "WHERE composition_id=? GROUP BY group_id",
+                (composition_id,)):
+            sizes[group_id] = size
+
+        return sizes
+
+
+class VirtualGroupLoader:
+    """
+    expands groups of complexes from a virtual bucket database. The
+    complexes for the most recently used composition are kept, since
+    the dispatcher hands out the groups of a composition one after
+    another.
+    """
+    def __init__(self, con):
+        cur = con.cursor()
+
+        (self.group_size,) = cur.execute(
+            "SELECT group_size FROM bucket_format").fetchone()
+
+        elements = [
+            element for _, element in
+            cur.execute("SELECT * FROM elements ORDER BY element_id")]
+
+        self.vectors = CompositionVectors(
+            elements,
+            [(species_id, tuple([int(n) for n in vector.split(',')]))
+             for species_id, vector in
+             cur.execute("SELECT * FROM species_vectors")])
+
+        self.compositions = {
+            composition_id: composition for composition_id, composition in
+            cur.execute("SELECT * FROM compositions")}
+
+        self.composition_id = None
+
+    def composition_complexes(self, composition_id):
+        if composition_id != self.composition_id:
+            self.composition_id = composition_id
+            self.singles, self.pairs = self.vectors.complexes(
+                self.vectors.key_from_composition(
+                    self.compositions[composition_id]))
+
+        return self.singles, self.pairs
+
+    def load(self, composition_id, group_id):
+        singles, pairs = self.composition_complexes(composition_id)
+
+        skip = group_id * self.group_size
+        group = []
+
+        if skip < len(singles):
+            group.extend(
+                [(s, -1) for s in singles[skip:skip + self.group_size]])
+            skip = 0
+        else:
+            skip -= len(singles)
+
+        for species_id, partners, start in pairs:
+            if len(group) == self.group_size:
+                break
+
+            count = len(partners) - start
+            if skip >= count:
+                skip -= count
+                continue
+
+            end = start + skip + self.group_size - len(group)
+            group.extend(
+                [(species_id, partner)
+                 for partner in partners[start + skip:end]])
+            skip = 0
+
+        return group
+
+    def group_sizes(self, composition_id, count):
+        singles, pairs = self.composition_complexes(composition_id)
+        complex_count = len(singles) + sum(
+            [len(partners) - start for _, partners, start in pairs])
+
+        return group_sizes(complex_count, self.group_size)
+
+
+def group_loader(con):
+    """
+    the right group loader for the bucket database con.
+    """
+    if 'bucket_format' in table_names(con):
+        return VirtualGroupLoader(con)
+    else:
+        return GroupLoader(con)
+
+
+"""
+bucket arrays:
+
+Workers read their groups from the bucket database, and when there
+are thousands of workers, the sqlite file (often on a parallel file
+system) gets a query from every one of them for every work batch.
+write_bucket_arrays exports the groups of a bucket database, in either
+format, to a directory of .npy arrays which ArrayGroupLoader opens with
+np.load(mmap_mode='r'). Loading a group is then a slice of a memory
+mapped array. The bucket database is still needed by the dispatcher.
+
+    complexes:           int32 array of shape (number_of_complexes, 2).
+                         The complexes of each group are contiguous and
+                         in the same order as the group loaders return
+                         them.
+    group_offsets:       the complexes of the k-th group overall are
+                         group_offsets[k]:group_offsets[k+1]
+    composition_offsets: the groups of composition_id are
+                         composition_offsets[composition_id]:
+                         composition_offsets[composition_id + 1]
+"""
+
+
+def write_bucket_arrays(bucket_db, array_dir, chunk_size=100000):
+
+    os.makedirs(array_dir, exist_ok=True)
+
+    con = sqlite3.connect(bucket_db)
+    loader = group_loader(con)
+    group_counts = sorted(con.execute("SELECT * FROM group_counts"))
+
+    composition_offsets = [0]
+    group_offsets = [0]
+    for composition_id, count in group_counts:
+        if composition_id != len(composition_offsets) - 1:
+            raise Exception("composition ids aren't consecutive")
+
+        for size in loader.group_sizes(composition_id, count):
+            group_offsets.append(group_offsets[-1] + size)
+
+        composition_offsets.append(len(group_offsets) - 1)
+
+    complexes = np.lib.format.open_memmap(
+        os.path.join(array_dir, 'complexes.npy'),
+        mode='w+',
+        dtype=np.int32,
+        shape=(group_offsets[-1], 2))
+
+    if isinstance(loader, GroupLoader):
+        # a single pass over the composition index, which has the
+        # complexes of each group in the same order as GroupLoader.load
+        rows = con.execute(
+            "SELECT species_1, species_2 FROM complexes "
+            "ORDER BY composition_id, group_id, rowid")
+
+        position = 0
+        while True:
+            chunk = rows.fetchmany(chunk_size)
+            if len(chunk) == 0:
+                break
+
+            complexes[position:position + len(chunk)] = np.array(
+                chunk, dtype=np.int32)
+            position += len(chunk)
+
+    else:
+        group_index = 0
+        for composition_id, count in group_counts:
+            for group_id in range(count):
+                group = loader.load(composition_id, group_id)
+                if len(group) > 0:
+                    complexes[group_offsets[group_index]:
+                              group_offsets[group_index + 1]] = np.array(
+                                  group, dtype=np.int32)
+
+                group_index += 1
+
+    complexes.flush()
+    del complexes
+    con.close()
+
+    np.save(
+        os.path.join(array_dir, 'group_offsets.npy'),
+        np.array(group_offsets, dtype=np.int64))
+
+    np.save(
+        os.path.join(array_dir, 'composition_offsets.npy'),
+        np.array(composition_offsets, dtype=np.int64))
+
+
+class ArrayGroupLoader:
+    """
+    loads groups of complexes from bucket arrays.
+    """
+    def __init__(self, array_dir):
+        self.complexes = np.load(
+            os.path.join(array_dir, 'complexes.npy'), mmap_mode='r')
+        self.group_offsets = np.load(
+            os.path.join(array_dir, 'group_offsets.npy'), mmap_mode='r')
+        self.composition_offsets = np.load(
+            os.path.join(array_dir, 'composition_offsets.npy'), mmap_mode='r')
+
+    def group_bounds(self, composition_id, group_id):
+        group_index = self.composition_offsets[composition_id] + group_id
+        return (
+            int(self.group_offsets[group_index]),
+            int(self.group_offsets[group_index + 1]))
+
+    def load(self, composition_id, group_id):
+        start, end = self.group_bounds(composition_id, group_id)
+
+        # tolist converts to python ints, which sqlite and the report
+        # generator expect
+        return [tuple(pair) for pair in self.complexes[start:end].tolist()]
+
+    def group_sizes(self, composition_id, count):
+        start = self.composition_offsets[composition_id]
+        offsets = self.group_offsets[start:start + count + 1]
+        return np.diff(offsets).tolist()
+
+
+def open_group_loader(bucket_db_file):
+    """
+    a group loader for bucket_db_file, which is either a bucket database
+    or a directory of bucket arrays.
+    """
+    if os.path.isdir(bucket_db_file):
+        return ArrayGroupLoader(bucket_db_file)
+    else:
+        return group_loader(sqlite3.connect(bucket_db_file))
+
+
+"""
+parallel bucketing:
+
+Every composition, with all of its groups, goes to exactly one shard,
+so shards can write their part of the complexes table independently
+and still use the global composition ids and group ids. Each shard
+computes the composition join itself, which is deterministic, so no
+communication is needed until the shards are merged. Compositions are
+assigned to shards largest first, each going to the shard with the
+fewest complexes so far.
+
+Shards are written by run_bucketing.py, one per MPI rank, or by
+parallel_bucket using a process pool. The merged database is the same
+as bucket(..., vector_join=True) writes, except for the order of the
+rows in the complexes table. Charge groups and skeleton order are done
+by the shards, like bucket does them, and the work batches for a
+target_batch_cost are packed by the merge, since they run across
+compositions from every shard.
+"""
+
+
+def shard_compositions(keys, complex_counts, number_of_shards):
+    """
+    returns the shard for each composition id.
+    """
+    shards = [0] * len(keys)
+    shard_heap = [(0, shard) for shard in range(number_of_shards)]
+
+    composition_ids = sorted(
+        range(len(keys)),
+        key=lambda composition_id: -complex_counts[keys[composition_id]])
+
+    for composition_id in composition_ids:
+        load, shard = heappop(shard_heap)
+        shards[composition_id] = shard
+        heappush(
+            shard_heap,
+            (load + complex_counts[keys[composition_id]], shard))
+
+    return shards
+
+
+def bucket_shard_path(bucket_db, shard):
+    return bucket_db + '.shard_' + str(shard)
+
+
+def shard_species(mol_entries, charge_groups=False, skeleton_order=False):
+    """
+    the species, charges and skeletons arguments of write_bucket_shard.
+    """
+    species = [(m.ind, list(m.species)) for m in mol_entries]
+
+    charges = None
+    if charge_groups:
+        charges = {m.ind: m.charge for m in mol_entries}
+
+    skeletons = None
+    if skeleton_order:
+        skeletons = {m.ind: m.covalent_hash for m in mol_entries}
+
+    return species, charges, skeletons
+
+
+def write_bucket_shard(
+        species,
+        shard_db,
+        shard,
+        number_of_shards,
+        group_size=1000,
+        chunk_size=100000,
+        charges=None,
+        skeletons=None):
+    """
+    species is a list of (species_id, list of elements) for all the
+    species. Writes the complexes, group_counts and compositions rows
+    for the compositions in shard to shard_db.
+
+    charges and skeletons are dicts from species id to charge and
+    covalent hash. If charges is given, the shard has charge groups and
+    also gets a group_charges table. If skeletons is given, the shard is
+    in skeleton order. See split_groups.
+    """
+
+    vectors = CompositionVectors.from_species(species)
+    keys, complex_counts, pair_classes = vectors.join()
+    shards = shard_compositions(keys, complex_counts, number_of_shards)
+
+    shard_composition_ids = [
+        composition_id for composition_id in range(len(keys))
+        if shards[composition_id] == shard]
+
+    con = sqlite3.connect(shard_db)
+    cur = con.cursor()
+
+    for pragma in bulk_pragmas:
+        cur.execute(pragma)
+
+    cur.execute(
+        "CREATE TABLE complexes (species_1, species_2, composition_id, group_id)")
+    cur.execute("CREATE TABLE group_counts (composition_id, count)")
+    cur.execute("CREATE TABLE compositions (composition_id, composition)")
+
+    # the (charge, size) of each group, for each composition in the shard
+    group_layouts = {}
+
+    def sorted_composition_rows(composition_id):
+        species_1, species_2 = composition_complexes(
+            vectors,
+            keys[composition_id],
+            pair_classes[keys[composition_id]])
+
+        species_1, species_2, group_ids, group_layouts[composition_id] = (
+            split_groups(species_1, species_2, group_size, charges, skeletons))
+
+        return zip(
+            species_1,
+            species_2,
+            repeat(composition_id, len(species_1)),
+            group_ids)
+
+    if charges is None and skeletons is None:
+        rows = chain.from_iterable(
+            composition_rows(
+                vectors,
+                keys[composition_id],
+                composition_id,
+                pair_classes[keys[composition_id]],
+                group_size)
+            for composition_id in shard_composition_ids)
+    else:
+        rows = chain.from_iterable(
+            sorted_composition_rows(composition_id)
+            for composition_id in shard_composition_ids)
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if len(chunk) == 0:
+            break
+
+        cur.executemany("INSERT INTO complexes VALUES (?, ?, ?, ?)", chunk)
+        con.commit()
+
+    if charges is None and skeletons is None:
+        cur.executemany(
+            "INSERT INTO group_counts VALUES (?, ?)",
+            [(composition_id,
+              complex_counts[keys[composition_id]] // group_size + 1)
+             for composition_id in shard_composition_ids])
+    else:
+        cur.executemany(
+            "INSERT INTO group_counts VALUES (?, ?)",
+            [(composition_id, len(group_layouts[composition_id]))
+             for composition_id in shard_composition_ids])
+
+    if charges is not None:
+        cur.execute(
+            "CREATE TABLE group_charges (composition_id, group_id, charge)")
+        cur.executemany(
+            "INSERT INTO group_charges VALUES (?, ?, ?)",
+            [(composition_id, group_id, charge)
+             for composition_id in shard_composition_ids
+             for group_id, (charge, _) in enumerate(
+                     group_layouts[composition_id])])
+
+    cur.executemany(
+        "INSERT INTO compositions VALUES (?, ?)",
+        [(composition_id, vectors.composition(keys[composition_id]))
+         for composition_id in shard_composition_ids])
+
+    con.commit()
+    con.close()
+
+
+def merge_bucket_shards(
+        bucket_db,
+        shard_dbs,
+        target_batch_cost=None,
+        charge_groups=False):
+    """
+    copies the tables from each shard into bucket_db and then creates
+    the composition index. charge_groups must be True if the shards
+    were written with charges. If target_batch_cost is given, the work
+    batches are packed from the group sizes of the merged database. The
+    shards must then have been written with
+    cost_balanced_group_size(target_batch_cost) as the group size.
+    """
+    con = sqlite3.connect(bucket_db)
+    cur = con.cursor()
+
+    for pragma in bulk_pragmas:
+        cur.execute(pragma)
+
+    cur.execute(
+        "CREATE TABLE complexes (species_1, species_2, composition_id, group_id)")
+    cur.execute("CREATE TABLE group_counts (composition_id, count)")
+    cur.execute("CREATE TABLE compositions (composition_id, composition)")
+    if charge_groups:
+        cur.execute(
+            "CREATE TABLE group_charges (composition_id, group_id, charge)")
+    con.commit()
+
+    # group_counts and compositions are small, so we collect them and
+    # write them in composition id order.
+    group_counts = []
+    compositions = []
+
+    for shard_db in shard_dbs:
+        cur.execute("ATTACH DATABASE ? AS shard", (shard_db,))
+        cur.execute("INSERT INTO complexes SELECT * FROM shard.complexes")
+        group_counts.extend(cur.execute("SELECT * FROM shard.group_counts"))
+        compositions.extend(cur.execute("SELECT * FROM shard.compositions"))
+        if charge_groups:
+            cur.execute(
+                "INSERT INTO group_charges SELECT * FROM shard.group_charges")
+        con.commit()
+        cur.execute("DETACH DATABASE shard")
+
+    cur.executemany("INSERT INTO group_counts VALUES (?, ?)", sorted(group_counts))
+    cur.executemany("INSERT INTO compositions VALUES (?, ?)", sorted(compositions))
+
+    cur.execute(
+        "CREATE INDEX composition_index ON complexes (composition_id, group_id)")
+
+    if target_batch_cost is not None:
+        # groups missing from the complexes table are empty
+        composition_group_sizes = [
+            [0] * count for _, count in sorted(group_counts)]
+
+        for composition_id, group_id, size in cur.execute(
+                "SELECT composition_id, group_id, COUNT(*) FROM complexes "
+                "GROUP BY composition_id, group_id"):
+            composition_group_sizes[composition_id][group_id] = size
+
+        write_work_batches(
+            cur,
+            cost_balanced_work_batches(
+                composition_group_sizes,
+                target_batch_cost))
+
+    con.commit()
+    con.close()
+
+
+class BucketShardTransfer:
+    """
+    writes a single bucket shard. This is a class rather than a closure
+    so that it can be passed into Pool(n).map.
+    """
+    def __init__(
+            self,
+            species,
+            bucket_db,
+            number_of_shards,
+            group_size,
+            charges=None,
+            skeletons=None):
+        self.species = species
+        self.bucket_db = bucket_db
+        self.number_of_shards = number_of_shards
+        self.group_size = group_size
+        self.charges = charges
+        self.skeletons = skeletons
+
+    def __call__(self, shard):
+        shard_db = bucket_shard_path(self.bucket_db, shard)
+        write_bucket_shard(
+            self.species,
+            shard_db,
+            shard,
+            self.number_of_shards,
+            self.group_size,
+            charges=self.charges,
+            skeletons=self.skeletons)
+
+        return shard_db
+
+
+def parallel_bucket(
+        mol_entries,
+        bucket_db,
+        number_of_processes,
+        group_size=1000,
+        target_batch_cost=None,
+        charge_groups=False,
+        skeleton_order=False):
+    """
+    bucket using a process pool. Each process writes a shard and then
+    the shards are merged into bucket_db. target_batch_cost,
+    charge_groups and skeleton_order are the same as for bucket.
+    """
+    if target_batch_cost is not None:
+        group_size = cost_balanced_group_size(target_batch_cost)
+
+    species, charges, skeletons = shard_species(
+        mol_entries,
+        charge_groups,
+        skeleton_order)
+
+    with Pool(number_of_processes) as pool:
+        shard_dbs = pool.map(
+            BucketShardTransfer(
+                species,
+                bucket_db,
+                number_of_processes,
+                group_size,
+                charges,
+                skeletons),
+            range(number_of_processes))
+
+    merge_bucket_shards(
+        bucket_db,
+        shard_dbs,
+        target_batch_cost,
+        charge_groups)
+
+    for shard_db in shard_dbs:
+        os.remove(shard_db)
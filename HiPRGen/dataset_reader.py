@@ -0,0 +1,102 @@
+import gzip
+import json
+from monty.json import MontyDecoder
+
+"""
+streaming reader for LIBE / MADEIRA dataset files.
+
+monty.serialization.loadfn decodes the whole dataset before species
+filtering starts, so the raw json, the decoded pymatgen objects and the
+mol entries are all in memory at the same time. stream_dataset_entries
+yields one decoded dataset entry at a time instead, so species_filter
+can drop an entry as soon as the species decision tree discards it.
+
+Supported inputs are a json array of entries or json lines (one entry
+per line, or more generally whitespace separated json values). Either
+can be gzip compressed, which is detected from the file contents.
+"""
+
+gzip_magic = b'\x1f\x8b'
+whitespace = ' \t\n\r'
+
+
+def open_dataset(path):
+    with open(path, 'rb') as f:
+        magic = f.read(2)
+
+    if magic == gzip_magic:
+        return gzip.open(path, 'rt')
+    else:
+        return open(path, 'r')
+
+
+def stream_dataset_entries(path, read_size=1 << 20):
+    json_decoder = json.JSONDecoder()
+    monty_decoder = MontyDecoder()
+
+    with open_dataset(path) as f:
+        buffer = ''
+        position = 0
+        end_of_file = False
+        is_array = None
+
+        def fill():
+            nonlocal buffer, position, end_of_file
+            data = f.read(read_size)
+            if data == '':
+                end_of_file = True
+
+            buffer = buffer[position:] + data
+            position = 0
+
+        def skip(characters):
+            nonlocal position
+            while True:
+                while (position < len(buffer) and
+                       buffer[position] in characters):
+                    position += 1
+
+                if position < len(buffer) or end_of_file:
+                    return
+
+                fill()
+
+        skip(whitespace)
+        if position == len(buffer):
+            return
+
+        if buffer[position] == '[':
+            is_array = True
+            position += 1
+
+        while True:
+            if is_array:
+                skip(whitespace + ',')
+                if position == len(buffer):
+                    raise ValueError(path + ": unterminated json array")
+
+                if buffer[position] == ']':
+                    return
+            else:
+                skip(whitespace)
+                if position == len(buffer):
+                    return
+
+            while True:
+                try:
+                    entry, end = json_decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if end_of_file:
+                        raise
+                    fill()
+                    continue
+
+                # a number at the end of the buffer may be truncated
+                if end == len(buffer) and not end_of_file:
+                    fill()
+                    continue
+
+                break
+
+            position = end
+            yield monty_decoder.process_decoded(entry)
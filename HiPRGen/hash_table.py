@@ -0,0 +1,76 @@
+import json
+from HiPRGen.reaction_questions import hydrogen_hash, hydrogen_hash_id
+
+"""
+interning of weisfeiler lehman hashes.
+
+The species hashes (total_hash, covalent_hash, star hashes and fragment
+hashes) are 32 character hex strings, and the hot reaction questions
+build dicts and sets of them for every candidate reaction. At the end
+of species filtering, we can replace every hash by its index in a
+HashTable, so the reaction questions compare small ints instead. The
+table is saved next to the species so hashes can be looked up again.
+
+hydrogen_hash is always interned first, so its id is hydrogen_hash_id.
+"""
+
+
+class HashTable:
+
+    def __init__(self, hashes=None):
+        if hashes is None:
+            hashes = [hydrogen_hash]
+
+        if hashes[hydrogen_hash_id] != hydrogen_hash:
+            raise Exception("hash table doesn't start with hydrogen_hash")
+
+        self.hashes = hashes
+        self.ids = {h: i for i, h in enumerate(hashes)}
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __call__(self, h):
+        """
+        returns the id of h, adding it to the table if it is new.
+        """
+        if h not in self.ids:
+            self.ids[h] = len(self.hashes)
+            self.hashes.append(h)
+
+        return self.ids[h]
+
+    def lookup(self, hash_id):
+        return self.hashes[hash_id]
+
+    def save(self, hash_table_location):
+        with open(hash_table_location, 'w') as f:
+            json.dump(self.hashes, f)
+
+    @classmethod
+    def load(cls, hash_table_location):
+        with open(hash_table_location, 'r') as f:
+            return cls(json.load(f))
+
+
+def intern_hashes(mol_entries, hash_table):
+    """
+    rewrite every hash stored on the mol entries to its id in
+    hash_table.
+    """
+    for mol in mol_entries:
+        mol.total_hash = hash_table(mol.total_hash)
+        mol.covalent_hash = hash_table(mol.covalent_hash)
+
+        for atom in mol.star_hashes:
+            mol.star_hashes[atom] = hash_table(mol.star_hashes[atom])
+
+        for fragment_complex in mol.fragment_data:
+            fragment_complex.fragment_hashes = [
+                hash_table(h) for h in fragment_complex.fragment_hashes]
+
+        coordimers = getattr(mol, 'coordimers', None)
+        if coordimers is not None:
+            mol.coordimers = {
+                hash_table(h): coordimer
+                for h, coordimer in coordimers.items()}
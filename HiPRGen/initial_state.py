@@ -3,35 +3,142 @@ from pymatgen.analysis.graphs import MoleculeGraph
 from pymatgen.analysis.local_env import OpenBabelNN
 from pymatgen.analysis.fragmenter import metal_edge_extender
 import sqlite3
+import os
+from networkx.algorithms.graph_hashing import weisfeiler_lehman_graph_hash
 
 
-def find_mol_entry_from_xyz_and_charge(mol_entries, xyz_file_path, charge):
+def mol_graph_from_xyz(xyz_file_path):
     """
-    given a file 'molecule.xyz', find the mol_entry corresponding to the
-    molecule graph with given charge
+    the molecule graph for the molecule in 'molecule.xyz'
     """
-    target_mol_graph = MoleculeGraph.with_local_env_strategy(
+    mol_graph = MoleculeGraph.with_local_env_strategy(
         Molecule.from_file(xyz_file_path), OpenBabelNN()
     )
 
     # correction to the molecule graph
-    target_mol_graph = metal_edge_extender(target_mol_graph)
+    return metal_edge_extender(mol_graph)
+
+
+def mol_graph_hash(mol_graph):
+    """
+    isomorphic molecule graphs have the same hash. MoleculeGraph
+    isomorphism ignores edge direction, so we hash the undirected graph.
+    """
+    return weisfeiler_lehman_graph_hash(
+        mol_graph.graph.to_undirected(),
+        node_attr='specie')
+
+
+class SpeciesIndex:
+    """
+    index for finding mol entries by entry id or by molecule graph.
+    Searching by molecule graph only runs isomorphism checks against
+    the mol entries with the same charge, formula and molecule graph
+    hash. The hashes are computed the first time a (charge, formula)
+    pair is searched for.
+
+    mol_entries must be full mol entries, since they need mol_graph.
+    """
+
+    def __init__(self, mol_entries):
+        self.mol_entries = mol_entries
+        self.entry_ids = {}
+        self.formula_groups = {}
+        self.hash_groups = {}
+
+        for i, mol_entry in enumerate(mol_entries):
+            if mol_entry.entry_id not in self.entry_ids:
+                self.entry_ids[mol_entry.entry_id] = i
+
+            key = (mol_entry.charge, mol_entry.formula)
+            if key not in self.formula_groups:
+                self.formula_groups[key] = []
+
+            self.formula_groups[key].append(i)
 
-    match = False
-    index = -1
-    while not match:
-        index += 1
-        mol_entry = mol_entries[index]
-        species_mol_graph = mol_entry.mol_graph
+    def find_by_entry_id(self, entry_id):
+        if entry_id in self.entry_ids:
+            return self.mol_entries[self.entry_ids[entry_id]].ind
+        else:
+            return None
 
-        if mol_entry.charge == charge:
-            match = target_mol_graph.isomorphic_to(species_mol_graph)
+    def candidates(self, charge, formula, graph_hash):
+        key = (charge, formula)
+        if key not in self.formula_groups:
+            return []
+
+        if key not in self.hash_groups:
+            hash_group = {}
+            for i in self.formula_groups[key]:
+                h = mol_graph_hash(self.mol_entries[i].mol_graph)
+                if h not in hash_group:
+                    hash_group[h] = []
+
+                hash_group[h].append(i)
+
+            self.hash_groups[key] = hash_group
+
+        return self.hash_groups[key].get(graph_hash, [])
+
+    def find_by_mol_graph(self, target_mol_graph, charge):
+        """
+        returns the index of the first mol entry with the given charge
+        whose molecule graph is isomorphic to target_mol_graph, or None
+        if there isn't one.
+        """
+        formula = target_mol_graph.molecule.composition.alphabetical_formula
+
+        for i in self.candidates(
+                charge,
+                formula,
+                mol_graph_hash(target_mol_graph)):
+
+            mol_entry = self.mol_entries[i]
+            if target_mol_graph.isomorphic_to(mol_entry.mol_graph):
+                return mol_entry.ind
 
-    if match:
-        return mol_entry.ind
-    else:
         return None
 
+    def find_by_xyz_and_charge(self, xyz_file_path, charge):
+        return self.find_by_mol_graph(
+            mol_graph_from_xyz(xyz_file_path),
+            charge)
+
+    def find_by_xyz_directory(
+            self,
+            xyz_directory,
+            charges=None,
+            default_charge=0):
+        """
+        looks up every .xyz file in xyz_directory. charges maps file
+        names without the .xyz extension to charges, and files which
+        aren't in charges get default_charge. Returns a dict mapping file
+        names without the extension to mol entry indices (or None).
+        """
+        if charges is None:
+            charges = {}
+
+        indices = {}
+        for file_name in sorted(os.listdir(xyz_directory)):
+            if file_name.endswith('.xyz'):
+                name = file_name[:-len('.xyz')]
+                indices[name] = self.find_by_xyz_and_charge(
+                    os.path.join(xyz_directory, file_name),
+                    charges.get(name, default_charge))
+
+        return indices
+
+
+def find_mol_entry_from_xyz_and_charge(mol_entries, xyz_file_path, charge):
+    """
+    given a file 'molecule.xyz', find the mol_entry corresponding to the
+    molecule graph with given charge. Returns None if there isn't one.
+    To look up lots of molecules, build a SpeciesIndex once instead.
+    """
+    return SpeciesIndex(mol_entries).find_by_xyz_and_charge(
+        xyz_file_path,
+        charge)
+
 def find_mol_entry_by_entry_id(mol_entries, entry_id):
     """
     given an entry_id, return the corresponding mol enentry index
@@ -258,3 +258,107 @@ class MoleculeEntry:
             return str(self) == str(other)
         else:
             return False
+
+
+
+class CompactMoleculeEntry:
+    """
+    A slimmed down MoleculeEntry for the phases after species
+    filtering. It only keeps the data read by bucketing and the reaction
+    questions, and uses __slots__ so there is no per instance __dict__.
+    The pymatgen molecule, the molecule graph and the networkx graphs
+    are dropped, so these can't be used for drawing molecules.
+    Every MPI rank holds a full copy of the species, so this is what
+    should be pickled for reaction filtering.
+    """
+
+    __slots__ = [
+        'ind',
+        'entry_id',
+        'formula',
+        'charge',
+        'spin_multiplicity',
+        'species',
+        'm_inds',
+        'free_energy',
+        'solvation_free_energy',
+        'electron_affinity',
+        'ionization_energy',
+        'total_hash',
+        'covalent_hash',
+        'star_hashes',
+        'fragment_data',
+        'coordimers'
+    ]
+
+    def __init__(
+            self,
+            ind,
+            entry_id,
+            formula,
+            charge,
+            spin_multiplicity,
+            species,
+            m_inds,
+            free_energy,
+            solvation_free_energy,
+            electron_affinity,
+            ionization_energy,
+            total_hash,
+            covalent_hash,
+            star_hashes,
+            fragment_data,
+            coordimers=None):
+
+        self.ind = ind
+        self.entry_id = entry_id
+        self.formula = formula
+        self.charge = charge
+        self.spin_multiplicity = spin_multiplicity
+        self.species = species
+        self.m_inds = m_inds
+        self.free_energy = free_energy
+        self.solvation_free_energy = solvation_free_energy
+        self.electron_affinity = electron_affinity
+        self.ionization_energy = ionization_energy
+        self.total_hash = total_hash
+        self.covalent_hash = covalent_hash
+        self.star_hashes = star_hashes
+        self.fragment_data = fragment_data
+        self.coordimers = coordimers
+
+    @classmethod
+    def from_mol_entry(cls, mol_entry):
+        """
+        the hashes, solvation free energy and coordimers are set by
+        species questions, so they may be missing from mol_entry.
+        """
+        return cls(
+            ind=mol_entry.ind,
+            entry_id=mol_entry.entry_id,
+            formula=mol_entry.formula,
+            charge=mol_entry.charge,
+            spin_multiplicity=mol_entry.spin_multiplicity,
+            species=mol_entry.species,
+            m_inds=mol_entry.m_inds,
+            free_energy=mol_entry.free_energy,
+            solvation_free_energy=getattr(
+                mol_entry, 'solvation_free_energy', None),
+            electron_affinity=mol_entry.electron_affinity,
+            ionization_energy=mol_entry.ionization_energy,
+            total_hash=getattr(mol_entry, 'total_hash', None),
+            covalent_hash=getattr(mol_entry, 'covalent_hash', None),
+            star_hashes=mol_entry.star_hashes,
+            fragment_data=mol_entry.fragment_data,
+            coordimers=getattr(mol_entry, 'coordimers', None)
+        )
+
+    def __repr__(self):
+        return "\n".join([
+            f"CompactMoleculeEntry {self.entry_id} - {self.formula}",
+            f"Total charge = {self.charge}",
+            f"Free Energy (298.15 K) = {self.free_energy} eV",
+            f"index: {self.ind}"])
+
+    def __str__(self):
+        return self.__repr__()
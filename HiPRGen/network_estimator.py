@@ -0,0 +1,267 @@
+import os
+import random
+import sqlite3
+import tempfile
+from time import perf_counter
+from itertools import permutations, product
+from HiPRGen.bucketing import open_group_loader, load_work_batches, triple_cost
+from HiPRGen.reaction_questions import run_decision_tree
+from HiPRGen.structural_memo import (
+    StructuralSkeletons,
+    memoize_structural_questions
+)
+from HiPRGen.reaction_filter import (
+    candidate_reaction,
+    reaction_row,
+    create_reactions_table,
+    insert_reaction
+)
+
+"""
+estimating the size and cost of reaction filtering before running it.
+
+estimate_network reads the bucket database the same way the dispatcher
+and workers do (the work batches from the dispatcher's bucket database
+and the groups from the worker's), so the candidate reaction counts for each work batch
+and composition are exact. It then runs a sample of the candidate
+reactions from each composition through the worker's decision trees,
+and projects the number of reactions which pass, the CPU time and the
+size of the reactions table from the pass rate and time per reaction
+measured for each composition.
+
+Compositions with at most samples_per_composition candidates are run
+in full, the others are sampled uniformly at random. If the worker
+payload has a structural memo, the sampled reactions are run with one
+too, but random samples get fewer memo hits than a worker running
+through whole groups, so the CPU time is an overestimate.
+"""
+
+
+def composition_candidates(loader, composition_id, triples):
+    """
+    all the candidate reactions of a composition from triples, in the
+    order the worker runs them.
+    """
+    candidates = []
+    for group_id_0, group_id_1 in triples:
+        if group_id_0 == group_id_1:
+            candidates.extend(permutations(
+                loader.load(composition_id, group_id_0), r=2))
+        else:
+            candidates.extend(product(
+                loader.load(composition_id, group_id_0),
+                loader.load(composition_id, group_id_1)))
+
+    return candidates
+
+
+def sample_candidates(
+        loader,
+        composition_id,
+        triples,
+        sizes,
+        number_of_samples,
+        rng):
+    """
+    number_of_samples candidate reactions from triples, chosen uniformly
+    at random with replacement.
+    """
+    groups = {}
+
+    def group(group_id):
+        if group_id not in groups:
+            groups[group_id] = loader.load(composition_id, group_id)
+        return groups[group_id]
+
+    samples = rng.choices(
+        triples,
+        weights=[triple_cost(sizes, i, j) for i, j in triples],
+        k=number_of_samples)
+
+    candidates = []
+    for group_id_0, group_id_1 in samples:
+        if group_id_0 == group_id_1:
+            candidates.append(tuple(rng.sample(group(group_id_0), 2)))
+        else:
+            candidates.append((
+                rng.choice(group(group_id_0)),
+                rng.choice(group(group_id_1))))
+
+    return candidates
+
+
+def reaction_row_bytes(rows, number_of_rows=10000):
+    """
+    the size of the reactions table per row, measured by writing
+    number_of_rows rows, cycling through rows, to a temporary database.
+    """
+    with tempfile.TemporaryDirectory() as temp_dir:
+        db_file = os.path.join(temp_dir, 'rn.sqlite')
+        con = sqlite3.connect(db_file)
+        con.execute(create_reactions_table)
+        con.executemany(
+            insert_reaction,
+            [(reaction_index,) + rows[reaction_index % len(rows)][1:]
+             for reaction_index in range(number_of_rows)])
+        con.commit()
+        con.close()
+
+        return os.path.getsize(db_file) / number_of_rows
+
+
+def estimate_network(
+        mol_entries,
+        dispatcher_payload,
+        worker_payload,
+        samples_per_composition=100,
+        seed=0):
+    """
+    returns a dict with the projected reaction filtering statistics
+    (see above). compositions has the numbers for each composition and
+    batch_candidate_counts has the number of candidate reactions in
+    each work batch.
+    """
+
+    rng = random.Random(seed)
+    con = sqlite3.connect(dispatcher_payload.bucket_db_file)
+    loader = open_group_loader(worker_payload.bucket_db_file)
+
+    work_batches = load_work_batches(
+        con,
+        dispatcher_payload.max_charge_difference)
+
+    composition_names = dict(con.execute("SELECT * FROM compositions"))
+    group_sizes = {
+        composition_id: loader.group_sizes(composition_id, count)
+        for composition_id, count in con.execute("SELECT * FROM group_counts")}
+
+    reaction_decision_tree = worker_payload.reaction_decision_tree
+    logging_decision_tree = worker_payload.logging_decision_tree
+
+    if worker_payload.structural_memo:
+        skeletons = StructuralSkeletons(mol_entries)
+        reaction_decision_tree = memoize_structural_questions(
+            reaction_decision_tree, skeletons)
+        logging_decision_tree = memoize_structural_questions(
+            logging_decision_tree, skeletons)
+
+    batch_candidate_counts = []
+    composition_triples = {}
+    for work_batch in work_batches:
+        count = 0
+        for composition_id, group_id_0, group_id_1 in work_batch:
+            cost = triple_cost(group_sizes[composition_id], group_id_0, group_id_1)
+            count += cost
+            if cost > 0:
+                if composition_id not in composition_triples:
+                    composition_triples[composition_id] = []
+
+                composition_triples[composition_id].append(
+                    (group_id_0, group_id_1))
+
+        batch_candidate_counts.append(count)
+
+    compositions = {}
+    passing_rows = []
+
+    for composition_id, triples in sorted(composition_triples.items()):
+        sizes = group_sizes[composition_id]
+        candidate_count = sum([triple_cost(sizes, i, j) for i, j in triples])
+
+        if candidate_count <= samples_per_composition:
+            candidates = composition_candidates(
+                loader, composition_id, triples)
+        else:
+            candidates = sample_candidates(
+                loader,
+                composition_id,
+                triples,
+                sizes,
+                samples_per_composition,
+                rng)
+
+        passed = 0
+        start_time = perf_counter()
+        for reactants, products in candidates:
+            reaction = candidate_reaction(reactants, products)
+            if run_decision_tree(reaction,
+                                 mol_entries,
+                                 worker_payload.params,
+                                 reaction_decision_tree):
+                passed += 1
+                passing_rows.append(reaction_row(0, reaction))
+
+            run_decision_tree(reaction,
+                              mol_entries,
+                              worker_payload.params,
+                              logging_decision_tree)
+
+        seconds_per_reaction = (
+            (perf_counter() - start_time) / len(candidates))
+
+        compositions[composition_id] = {
+            'composition': composition_names[composition_id],
+            'candidate_reactions': candidate_count,
+            'sampled_reactions': len(candidates),
+            'sampled_passing': passed,
+            'projected_reactions': candidate_count * passed / len(candidates),
+            'seconds_per_reaction': seconds_per_reaction,
+            'projected_seconds': candidate_count * seconds_per_reaction
+        }
+
+    con.close()
+
+    batch_seconds = [
+        sum([triple_cost(group_sizes[composition_id], group_id_0, group_id_1) *
+             compositions[composition_id]['seconds_per_reaction']
+             for composition_id, group_id_0, group_id_1 in work_batch
+             if composition_id in compositions])
+        for work_batch in work_batches]
+
+    candidate_reactions = sum(batch_candidate_counts)
+    sampled_reactions = sum(
+        [c['sampled_reactions'] for c in compositions.values()])
+    sampled_passing = sum(
+        [c['sampled_passing'] for c in compositions.values()])
+    projected_reactions = sum(
+        [c['projected_reactions'] for c in compositions.values()])
+    projected_seconds = sum(batch_seconds)
+
+    if len(passing_rows) > 0:
+        bytes_per_reaction = reaction_row_bytes(passing_rows)
+    else:
+        bytes_per_reaction = 0.0
+
+    if len(work_batches) > 0:
+        worst_batch_index = max(
+            range(len(work_batches)),
+            key=batch_seconds.__getitem__)
+
+        worst_batch = {
+            'batch_index': worst_batch_index,
+            'triples': work_batches[worst_batch_index],
+            'candidate_reactions': batch_candidate_counts[worst_batch_index],
+            'projected_seconds': batch_seconds[worst_batch_index]
+        }
+    else:
+        worst_batch = None
+
+    if candidate_reactions > 0:
+        projected_pass_rate = projected_reactions / candidate_reactions
+    else:
+        projected_pass_rate = 0.0
+
+    return {
+        'number_of_work_batches': len(work_batches),
+        'candidate_reactions': candidate_reactions,
+        'sampled_reactions': sampled_reactions,
+        'sampled_passing': sampled_passing,
+        'projected_reactions': projected_reactions,
+        'projected_pass_rate': projected_pass_rate,
+        'projected_cpu_seconds': projected_seconds,
+        'bytes_per_reaction': bytes_per_reaction,
+        'projected_db_bytes': projected_reactions * bytes_per_reaction,
+        'worst_batch': worst_batch,
+        'compositions': compositions,
+        'batch_candidate_counts': batch_candidate_counts
+    }
@@ -1,6 +1,8 @@
+import os
 import sqlite3
 import pickle
 import numpy as np
+from HiPRGen.species_store import SpeciesStore
 
 """
 class for dynamically loading a reaction network
@@ -38,8 +40,14 @@ class NetworkLoader:
 
         self.rn_con = sqlite3.connect(network_database)
 
-        with open(mol_entries_pickle, 'rb') as f:
-            self.mol_entries = pickle.load(f)
+        # mol_entries_pickle can also be a species store directory. The
+        # store doesn't contain molecule graphs, so it can't be used
+        # for drawing molecules.
+        if os.path.isdir(mol_entries_pickle):
+            self.mol_entries = SpeciesStore(mol_entries_pickle)
+        else:
+            with open(mol_entries_pickle, 'rb') as f:
+                self.mol_entries = pickle.load(f)
 
         cur = self.rn_con.cursor()
         metadata = list(cur.execute("SELECT * FROM metadata"))[0]
@@ -1,10 +1,15 @@
 from mpi4py import MPI
+import os
 from itertools import permutations, product
+import numpy as np
 from HiPRGen.report_generator import ReportGenerator
 import sqlite3
+from queue import Queue
+from threading import Thread
 from time import localtime, strftime, time
 from enum import Enum
 from math import floor
+from HiPRGen.bucketing import open_group_loader, load_work_batches
 from HiPRGen.reaction_filter_payloads import (
     DispatcherPayload,
     WorkerPayload
@@ -14,6 +19,11 @@ from HiPRGen.reaction_questions import (
     run_decision_tree
 )
 
+from HiPRGen.structural_memo import (
+    StructuralSkeletons,
+    memoize_structural_questions
+)
+
 """
 Phases 3 & 4 run in paralell using MPI
 
@@ -65,11 +75,49 @@ insert_reaction = """
     INSERT INTO reactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
 """
 
-get_complex_group_sql = """
-    SELECT * FROM complexes WHERE composition_id=? AND group_id=?
+# copies the reactions from an attached shard, offsetting their ids
+merge_reaction_shard = """
+    INSERT INTO main.reactions
+    SELECT reaction_id + ?,
+           number_of_reactants,
+           number_of_products,
+           reactant_1,
+           reactant_2,
+           product_1,
+           product_2,
+           rate,
+           dG,
+           dG_barrier,
+           is_redox
+    FROM shard.reactions ORDER BY reaction_id
 """
 
 
+def candidate_reaction(reactants, products):
+    return {
+        'reactants' : reactants,
+        'products' : products,
+        'number_of_reactants' : len([i for i in reactants if i != -1]),
+        'number_of_products' : len([i for i in products if i != -1])}
+
+
+def reaction_row(reaction_index, reaction):
+    """
+    the row of the reactions table for reaction.
+    """
+    return (
+        reaction_index,
+        reaction['number_of_reactants'],
+        reaction['number_of_products'],
+        reaction['reactants'][0],
+        reaction['reactants'][1],
+        reaction['products'][0],
+        reaction['products'][1],
+        reaction['rate'],
+        reaction['dG'],
+        reaction['dG_barrier'],
+        reaction['is_redox'])
+
 # TODO: structure these global variables better
 DISPATCHER_RANK = 0
 
@@ -91,6 +139,225 @@ NEW_REACTION_DB = 3
 # sent by workers to the dispatcher when reaction passes logging decision tree
 NEW_REACTION_LOGGING = 4
 
+# sent by workers to the dispatcher with a block of reactions which
+# passed the db decision tree. Unlike the other messages, this is a
+# reaction_block_dtype buffer rather than a pickled object.
+NEW_REACTION_BLOCK = 5
+
+# the fields are in the same order as the columns of the reactions
+# table after reaction_id.
+reaction_block_dtype = np.dtype([
+    ('number_of_reactants', np.int8),
+    ('number_of_products', np.int8),
+    ('reactant_1', np.int32),
+    ('reactant_2', np.int32),
+    ('product_1', np.int32),
+    ('product_2', np.int32),
+    ('rate', np.float64),
+    ('dG', np.float64),
+    ('dG_barrier', np.float64),
+    ('is_redox', np.int8)
+])
+
+
+class ReactionBlock:
+    """
+    buffers the reactions which pass the db decision tree on a worker,
+    so that they can be sent to the dispatcher as a single message
+    rather than one pickled dict per reaction. Sub-dispatchers also use
+    a ReactionBlock to collect the reactions from their workers.
+    """
+    def __init__(self, comm, block_size, dest=DISPATCHER_RANK):
+        self.comm = comm
+        self.dest = dest
+        self.buffer = np.empty(block_size, dtype=reaction_block_dtype)
+        self.count = 0
+
+    def add(self, reaction):
+        self.buffer[self.count] = reaction_row(0, reaction)[1:]
+        self.count += 1
+
+        if self.count == len(self.buffer):
+            self.flush()
+
+    def add_rows(self, rows):
+        """
+        add a received block of reactions.
+        """
+        start = 0
+        while start < len(rows):
+            count = min(len(rows) - start, len(self.buffer) - self.count)
+            self.buffer[self.count:self.count + count] = (
+                rows[start:start + count])
+            self.count += count
+            start += count
+
+            if self.count == len(self.buffer):
+                self.flush()
+
+    def flush(self):
+        if self.count > 0:
+            self.comm.Send(
+                [self.buffer[:self.count], MPI.BYTE],
+                dest=self.dest,
+                tag=NEW_REACTION_BLOCK)
+
+            self.count = 0
+
+
+# PRAGMAs used by the ReactionWriter. The journal and fsyncs are turned
+# off and the writer holds an exclusive lock on the reaction network
+# database until it is finished, so if the dispatcher is interrupted
+# the database must be regenerated from scratch.
+writer_pragmas = [
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF",
+    "PRAGMA cache_size = -1048576",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA locking_mode = EXCLUSIVE"
+]
+
+
+class ReactionWriter:
+    """
+    writes rows of the reactions table on a background thread, so the
+    dispatcher never waits on sqlite while it is handling MPI messages.
+    The dispatcher collects rows into blocks and puts them on a queue
+    of at most queue_size blocks, and the writer thread inserts each
+    block with executemany on its own connection and commits it. The
+    dispatcher only blocks if the queue is full, which means the disk
+    is falling behind the workers.
+
+    If an insert fails, the writer thread keeps draining the queue so
+    the dispatcher doesn't hang, and finish raises the error.
+    """
+    def __init__(self, reaction_network_db_file, block_size, queue_size):
+        self.reaction_network_db_file = reaction_network_db_file
+        self.block_size = block_size
+        self.queue = Queue(maxsize=queue_size)
+        self.rows = []
+        self.error = None
+        self.thread = Thread(target=self.run)
+        self.thread.start()
+
+    def run(self):
+        con = sqlite3.connect(self.reaction_network_db_file)
+        cur = con.cursor()
+        for pragma in writer_pragmas:
+            cur.execute(pragma)
+
+        while True:
+            rows = self.queue.get()
+            if rows is None:
+                break
+
+            if self.error is None:
+                try:
+                    cur.executemany(insert_reaction, rows)
+                    con.commit()
+                except Exception as e:
+                    self.error = e
+
+        con.close()
+
+    def add(self, rows):
+        self.rows.extend(rows)
+
+        if len(self.rows) >= self.block_size:
+            self.queue.put(self.rows)
+            self.rows = []
+
+    def finish(self):
+        if len(self.rows) > 0:
+            self.queue.put(self.rows)
+            self.rows = []
+
+        self.queue.put(None)
+        self.thread.join()
+
+        if self.error is not None:
+            raise Exception(
+                "writing the reaction network database failed: " +
+                str(self.error))
+
+
+# PRAGMAs used for the reaction shards written by the workers. Unlike
+# the ReactionWriter, they don't take an exclusive lock, so that the
+# dispatcher can read a shard once its worker is finished.
+shard_pragmas = [
+    "PRAGMA journal_mode = OFF",
+    "PRAGMA synchronous = OFF"
+]
+
+
+def reaction_shard_path(reaction_shard_dir, rank):
+    return os.path.join(reaction_shard_dir, 'reactions_%d.sqlite' % rank)
+
+
+class ReactionShard:
+    """
+    writes the reactions which pass the db decision tree on a worker to
+    the worker's own shard of the reactions table, instead of sending
+    them to the dispatcher. Reactions are inserted in blocks of up to
+    block_size and at the end of each work batch. The reaction ids in a
+    shard start from 0, merge_reaction_shards offsets them.
+    """
+    def __init__(self, shard_file, block_size=10000):
+        if os.path.exists(shard_file):
+            os.remove(shard_file)
+
+        self.con = sqlite3.connect(shard_file)
+        self.cur = self.con.cursor()
+        for pragma in shard_pragmas:
+            self.cur.execute(pragma)
+
+        self.cur.execute(create_reactions_table)
+        self.con.commit()
+        self.block_size = block_size
+        self.rows = []
+        self.count = 0
+
+    def add(self, reaction):
+        self.rows.append(reaction_row(self.count, reaction))
+        self.count += 1
+
+        if len(self.rows) == self.block_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.rows) > 0:
+            self.cur.executemany(insert_reaction, self.rows)
+            self.con.commit()
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.con.close()
+
+
+def merge_reaction_shards(rn_con, shard_files, first_reaction_id=0):
+    """
+    appends the reactions in each of shard_files to the reactions table
+    of rn_con, in order, with contiguous reaction ids starting from
+    first_reaction_id. Each shard is copied inside sqlite with a single
+    INSERT SELECT. Returns the id after the last reaction.
+    """
+    cur = rn_con.cursor()
+    reaction_id = first_reaction_id
+
+    for shard_file in shard_files:
+        rn_con.commit()
+        cur.execute("ATTACH DATABASE ? AS shard", (shard_file,))
+        count = cur.execute(
+            "SELECT COUNT(*) FROM shard.reactions").fetchone()[0]
+        cur.execute(merge_reaction_shard, (reaction_id,))
+        rn_con.commit()
+        cur.execute("DETACH DATABASE shard")
+        reaction_id += count
+
+    return reaction_id
+
+
 class WorkerState(Enum):
     INITIALIZING = 0
     RUNNING = 1
@@ -102,22 +369,181 @@ def log_message(*args, **kwargs):
         '[' + strftime('%H:%M:%S', localtime()) + ']',
         *args, **kwargs)
 
+
+def receive_message(comm):
+    """
+    receive the next message from any rank. Returns the tag, the source
+    rank and the data.
+    """
+    # reaction blocks are raw buffers, so we probe for the next
+    # message before receiving it
+    status = MPI.Status()
+    comm.Probe(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
+    tag = status.Get_tag()
+    rank = status.Get_source()
+
+    if tag == NEW_REACTION_BLOCK:
+        data = np.empty(
+            status.Get_count(MPI.BYTE) // reaction_block_dtype.itemsize,
+            dtype=reaction_block_dtype)
+        comm.Recv([data, MPI.BYTE], source=rank, tag=tag)
+    else:
+        data = comm.recv(source=rank, tag=tag)
+
+    return tag, rank, data
+
+
+def dispatch_tree(comm, sub_dispatchers):
+    """
+    returns, for each rank, the rank it requests work batches from and
+    sends its reactions to, or None for the dispatcher. Without
+    sub_dispatchers, every worker talks to the dispatcher. With
+    sub_dispatchers, on each node with at least three ranks other than
+    the dispatcher, the lowest of them is a sub-dispatcher for the
+    others. Collective over comm.
+    """
+    rank = comm.Get_rank()
+    if rank == DISPATCHER_RANK:
+        upstream_rank = None
+    else:
+        upstream_rank = DISPATCHER_RANK
+
+    if sub_dispatchers:
+        node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+        node_ranks = sorted([
+            i for i in node_comm.allgather(rank) if i != DISPATCHER_RANK])
+        node_comm.Free()
+
+        if (len(node_ranks) >= 3 and
+            rank != DISPATCHER_RANK and
+            rank != node_ranks[0]):
+            upstream_rank = node_ranks[0]
+
+    return comm.allgather(upstream_rank)
+
+
+class ChunkReplies:
+    """
+    sends the replies to chunk requests with isend. A prefetching worker
+    only receives the reply to its request once it is done with its
+    current work batch, so a blocking send of a chunk too large to be
+    sent eagerly would stall the dispatcher until then. The send
+    requests are kept until they complete, and finish waits for the
+    rest.
+    """
+    def __init__(self, comm):
+        self.comm = comm
+        self.requests = []
+
+    def send(self, work_chunk, dest):
+        self.requests = [
+            request for request in self.requests if not request.Test()]
+
+        self.requests.append(
+            self.comm.isend(work_chunk, dest=dest, tag=HERE_IS_A_WORK_BATCH))
+
+    def finish(self):
+        MPI.Request.Waitall(self.requests)
+        self.requests = []
+
+
+def sub_dispatcher(comm, worker_ranks, chunk_size, block_size):
+    """
+    serves the workers on a node. A sub-dispatcher requests chunk_size
+    work batches at a time from the dispatcher and hands them out to
+    its workers one at a time. The reactions from its workers are
+    collected into blocks of block_size, and reactions for the report
+    are forwarded as they are. So the dispatcher gets a message for
+    every chunk and every block, rather than for every work batch and
+    every reaction.
+
+    Once the dispatcher is out of work batches, the sub-dispatcher waits
+    for its workers to finish, sends the last reactions and then makes
+    a final request for a single work batch, which finishes it like any
+    other worker.
+    """
+    # workers send a list of their shard files
+    shard_files = []
+    for i in worker_ranks:
+        shard_files.extend(comm.recv(source=i, tag=INITIALIZATION_FINISHED))
+
+    comm.send(shard_files, dest=DISPATCHER_RANK, tag=INITIALIZATION_FINISHED)
+
+    reaction_block = ReactionBlock(comm, block_size)
+    chunk_replies = ChunkReplies(comm)
+    work_batch_list = []
+    out_of_work_batches = False
+    running_ranks = set(worker_ranks)
+
+    while len(running_ranks) > 0:
+        tag, rank, data = receive_message(comm)
+
+        if tag == SEND_ME_A_WORK_BATCH:
+            if len(work_batch_list) == 0 and not out_of_work_batches:
+                reaction_block.flush()
+                comm.send(chunk_size, dest=DISPATCHER_RANK, tag=SEND_ME_A_WORK_BATCH)
+                work_batch_list = comm.recv(
+                    source=DISPATCHER_RANK,
+                    tag=HERE_IS_A_WORK_BATCH)
+
+                # hand out the chunk in the order the dispatcher popped it
+                work_batch_list.reverse()
+                out_of_work_batches = len(work_batch_list) == 0
+
+            if data is not None:
+                # a prefetching worker, see prefetched_work_batches
+                chunk_replies.send(
+                    [work_batch_list.pop()
+                     for _ in range(min(data, len(work_batch_list)))],
+                    rank)
+
+            elif len(work_batch_list) == 0:
+                comm.send(None, dest=rank, tag=HERE_IS_A_WORK_BATCH)
+                running_ranks.remove(rank)
+            else:
+                comm.send(
+                    work_batch_list.pop(),
+                    dest=rank,
+                    tag=HERE_IS_A_WORK_BATCH)
+
+        elif tag == NEW_REACTION_DB:
+            reaction_block.add(data)
+
+        elif tag == NEW_REACTION_BLOCK:
+            reaction_block.add_rows(data)
+
+        elif tag == NEW_REACTION_LOGGING:
+            comm.send(data, dest=DISPATCHER_RANK, tag=NEW_REACTION_LOGGING)
+
+    chunk_replies.finish()
+    reaction_block.flush()
+    comm.send(None, dest=DISPATCHER_RANK, tag=SEND_ME_A_WORK_BATCH)
+    comm.recv(source=DISPATCHER_RANK, tag=HERE_IS_A_WORK_BATCH)
+
 def dispatcher(
         mol_entries,
         dispatcher_payload
 ):
 
     comm = MPI.COMM_WORLD
-    work_batch_list = []
+    comm.bcast(
+        (dispatcher_payload.sub_dispatcher_chunk_size,
+         dispatcher_payload.sub_dispatcher_block_size),
+        root=DISPATCHER_RANK)
+
+    upstream_ranks = dispatch_tree(
+        comm,
+        dispatcher_payload.sub_dispatcher_chunk_size is not None)
+
     bucket_con = sqlite3.connect(dispatcher_payload.bucket_db_file)
     bucket_cur = bucket_con.cursor()
-    size_cur = bucket_con.cursor()
 
-    res = bucket_cur.execute("SELECT * FROM group_counts")
-    for (composition_id, count) in res:
-        for (i,j) in product(range(count), repeat=2):
-            work_batch_list.append(
-                (composition_id, i, j))
+    # a work batch is a list of (composition_id, group_id_0, group_id_1)
+    # triples. Unless the bucket database was written with a
+    # target_batch_cost, each work batch is a single triple.
+    work_batch_list = load_work_batches(
+        bucket_con,
+        dispatcher_payload.max_charge_difference)
 
     composition_names = {}
     res = bucket_cur.execute("SELECT * FROM compositions")
@@ -131,6 +557,14 @@ def dispatcher(
     rn_cur.execute(create_reactions_table)
     rn_con.commit()
 
+    if dispatcher_payload.writer_block_size is not None:
+        reaction_writer = ReactionWriter(
+            dispatcher_payload.reaction_network_db_file,
+            dispatcher_payload.writer_block_size,
+            dispatcher_payload.writer_queue_size)
+    else:
+        reaction_writer = None
+
     log_message("initializing report generator")
 
     # since MPI processes spin lock, we don't want to have the dispathcer
@@ -143,19 +577,29 @@ def dispatcher(
 
     worker_states = {}
 
-    worker_ranks = [i for i in range(comm.Get_size()) if i != DISPATCHER_RANK]
+    # the workers and sub-dispatchers which talk to the dispatcher
+    worker_ranks = [
+        i for i in range(comm.Get_size())
+        if upstream_ranks[i] == DISPATCHER_RANK]
 
     for i in worker_ranks:
         worker_states[i] = WorkerState.INITIALIZING
 
+    # workers send a list of the shards they write their reactions to
+    # when they finish initializing, sub-dispatchers send the shards of
+    # all their workers
+    reaction_shard_files = []
+
     for i in worker_states:
         # block, waiting for workers to initialize
-        comm.recv(source=i, tag=INITIALIZATION_FINISHED)
+        reaction_shard_files.extend(
+            comm.recv(source=i, tag=INITIALIZATION_FINISHED))
         worker_states[i] = WorkerState.RUNNING
 
     log_message("all workers running")
 
     reaction_index = 0
+    chunk_replies = ChunkReplies(comm)
 
     log_message("handling requests")
 
@@ -186,12 +630,29 @@ def dispatcher(
             last_checkpoint_time = current_time
 
 
-        status = MPI.Status()
-        data = comm.recv(source=MPI.ANY_SOURCE, tag=MPI.ANY_TAG, status=status)
-        tag = status.Get_tag()
-        rank = status.Get_source()
+        tag, rank, data = receive_message(comm)
 
-        if tag == SEND_ME_A_WORK_BATCH:
+        if tag == SEND_ME_A_WORK_BATCH and data is not None:
+            # a sub-dispatcher or a prefetching worker asking for a
+            # chunk of data work batches. An empty chunk doesn't finish
+            # it, it makes a final request for a single work batch once
+            # all its reactions have been sent.
+            work_chunk = [
+                work_batch_list.pop()
+                for _ in range(min(data, len(work_batch_list)))]
+
+            chunk_replies.send(work_chunk, rank)
+            for work_batch in work_chunk:
+                for composition_id, group_id_0, group_id_1 in work_batch:
+                    log_message(
+                        "dispatched",
+                        composition_names[composition_id],
+                        ": group ids:",
+                        group_id_0, group_id_1
+                    )
+
+
+        elif tag == SEND_ME_A_WORK_BATCH:
             if len(work_batch_list) == 0:
                 comm.send(None, dest=rank, tag=HERE_IS_A_WORK_BATCH)
                 worker_states[rank] = WorkerState.FINISHED
@@ -199,37 +660,52 @@ def dispatcher(
                 # pop removes and returns the last item in the list
                 work_batch = work_batch_list.pop()
                 comm.send(work_batch, dest=rank, tag=HERE_IS_A_WORK_BATCH)
-                composition_id, group_id_0, group_id_1 = work_batch
-                log_message(
-                    "dispatched",
-                    composition_names[composition_id],
-                    ": group ids:",
-                    group_id_0, group_id_1
-                )
+                for composition_id, group_id_0, group_id_1 in work_batch:
+                    log_message(
+                        "dispatched",
+                        composition_names[composition_id],
+                        ": group ids:",
+                        group_id_0, group_id_1
+                    )
+
+
+        elif tag == NEW_REACTION_DB and reaction_writer is not None:
+            reaction_writer.add([reaction_row(reaction_index, data)])
+            reaction_index += 1
 
 
         elif tag == NEW_REACTION_DB:
             reaction = data
             rn_cur.execute(
                 insert_reaction,
-                (reaction_index,
-                 reaction['number_of_reactants'],
-                 reaction['number_of_products'],
-                 reaction['reactants'][0],
-                 reaction['reactants'][1],
-                 reaction['products'][0],
-                 reaction['products'][1],
-                 reaction['rate'],
-                 reaction['dG'],
-                 reaction['dG_barrier'],
-                 reaction['is_redox']
-                 ))
+                reaction_row(reaction_index, reaction))
 
             reaction_index += 1
             if reaction_index % dispatcher_payload.commit_frequency == 0:
                 rn_con.commit()
 
 
+        elif tag == NEW_REACTION_BLOCK and reaction_writer is not None:
+            reaction_writer.add(
+                [(reaction_index + i,) + row
+                 for i, row in enumerate(data.tolist())])
+
+            reaction_index += len(data)
+
+
+        elif tag == NEW_REACTION_BLOCK:
+            rn_cur.executemany(
+                insert_reaction,
+                [(reaction_index + i,) + row
+                 for i, row in enumerate(data.tolist())])
+
+            previous_reaction_index = reaction_index
+            reaction_index += len(data)
+            if (previous_reaction_index // dispatcher_payload.commit_frequency !=
+                reaction_index // dispatcher_payload.commit_frequency):
+                rn_con.commit()
+
+
         elif tag == NEW_REACTION_LOGGING:
 
             reaction = data[0]
@@ -242,7 +718,27 @@ def dispatcher(
 
 
 
+    chunk_replies.finish()
+
     log_message("finalzing database and generation report")
+    if reaction_writer is not None:
+        # the writer holds an exclusive lock until it is finished
+        reaction_writer.finish()
+
+    if len(reaction_shard_files) > 0:
+        log_message("merging", len(reaction_shard_files), "reaction shards")
+        rn_con.commit()
+        for pragma in writer_pragmas:
+            rn_cur.execute(pragma)
+
+        reaction_index = merge_reaction_shards(
+            rn_con,
+            reaction_shard_files,
+            reaction_index)
+
+        for shard_file in reaction_shard_files:
+            os.remove(shard_file)
+
     rn_cur.execute(
         insert_metadata,
         (len(mol_entries),
@@ -256,94 +752,263 @@ def dispatcher(
     rn_con.close()
 
 
-def worker(
-        mol_entries,
-        worker_payload
-):
+class LoadedGroups:
+    """
+    the groups of a work batch, loaded by a GroupPrefetcher. Has the
+    same load method as the group loaders.
+    """
+    def __init__(self, groups):
+        self.groups = groups
+
+    def load(self, composition_id, group_id):
+        return self.groups[(composition_id, group_id)]
+
+
+class GroupPrefetcher:
+    """
+    loads the groups of work batches on a helper thread, so that a
+    worker can read the groups of its next work batch while the current
+    one runs through the decision trees. The helper thread opens its own
+    group loader, since sqlite connections can't be shared between
+    threads. Work batches are loaded in the order they are prefetched.
+    """
+    def __init__(self, bucket_db_file):
+        self.bucket_db_file = bucket_db_file
+        self.work_batches = Queue()
+        self.loaded_groups = Queue()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        loader = open_group_loader(self.bucket_db_file)
+
+        while True:
+            work_batch = self.work_batches.get()
+            if work_batch is None:
+                break
+
+            try:
+                groups = {}
+                for composition_id, group_id_0, group_id_1 in work_batch:
+                    for group_id in [group_id_0, group_id_1]:
+                        if (composition_id, group_id) not in groups:
+                            groups[(composition_id, group_id)] = loader.load(
+                                composition_id, group_id)
+
+                self.loaded_groups.put(LoadedGroups(groups))
+            except Exception as e:
+                self.loaded_groups.put(e)
+
+    def prefetch(self, work_batch):
+        self.work_batches.put(work_batch)
+
+    def get(self):
+        loaded_groups = self.loaded_groups.get()
+        if isinstance(loaded_groups, Exception):
+            raise loaded_groups
+
+        return loaded_groups
+
+    def close(self):
+        self.work_batches.put(None)
+        self.thread.join()
+
+
+def requested_work_batches(comm, dispatcher_rank, loader):
+    """
+    yields the work batches for a worker, along with the loader for
+    their groups, requesting each one once the previous one is done.
+    """
+    while True:
+        comm.send(None, dest=dispatcher_rank, tag=SEND_ME_A_WORK_BATCH)
+        work_batch = comm.recv(source=dispatcher_rank, tag=HERE_IS_A_WORK_BATCH)
 
-    comm = MPI.COMM_WORLD
-    con = sqlite3.connect(worker_payload.bucket_db_file)
-    cur = con.cursor()
+        if work_batch is None:
+            break
 
+        yield work_batch, loader
 
-    comm.send(None, dest=DISPATCHER_RANK, tag=INITIALIZATION_FINISHED)
 
-    while True:
-        comm.send(None, dest=DISPATCHER_RANK, tag=SEND_ME_A_WORK_BATCH)
-        work_batch = comm.recv(source=DISPATCHER_RANK, tag=HERE_IS_A_WORK_BATCH)
+def prefetched_work_batches(comm, dispatcher_rank, bucket_db_file):
+    """
+    yields the work batches for a worker, along with their loaded
+    groups, keeping one request for a work batch outstanding and the
+    groups of the next work batch loading while the worker runs the
+    current one.
 
-        if work_batch is None:
-            break
+    Prefetch requests ask for a chunk of one work batch, like the
+    sub-dispatchers do, so an empty reply doesn't finish the worker.
+    Since the reply is only received after the current work batch, the
+    dispatchers send it with isend, see ChunkReplies.
+    Once the last work batch is done, and its reactions have been sent,
+    the worker makes a final request for a single work batch.
+    """
+    prefetcher = GroupPrefetcher(bucket_db_file)
 
+    comm.send(1, dest=dispatcher_rank, tag=SEND_ME_A_WORK_BATCH)
+    work_chunk = comm.recv(source=dispatcher_rank, tag=HERE_IS_A_WORK_BATCH)
 
-        composition_id, group_id_0, group_id_1 = work_batch
+    request = None
+    if len(work_chunk) > 0:
+        prefetcher.prefetch(work_chunk[0])
+        request = comm.isend(1, dest=dispatcher_rank, tag=SEND_ME_A_WORK_BATCH)
 
+    while len(work_chunk) > 0:
+        # the reply to the request made before the previous work batch
+        request.wait()
+        next_work_chunk = comm.recv(
+            source=dispatcher_rank,
+            tag=HERE_IS_A_WORK_BATCH)
 
-        if group_id_0 == group_id_1:
+        if len(next_work_chunk) > 0:
+            prefetcher.prefetch(next_work_chunk[0])
+            request = comm.isend(
+                1,
+                dest=dispatcher_rank,
+                tag=SEND_ME_A_WORK_BATCH)
 
-            res = cur.execute(
-                get_complex_group_sql,
-                (composition_id, group_id_0))
+        yield work_chunk[0], prefetcher.get()
+        work_chunk = next_work_chunk
 
-            bucket = []
-            for row in res:
-                bucket.append((row[0],row[1]))
+    prefetcher.close()
+    comm.send(None, dest=dispatcher_rank, tag=SEND_ME_A_WORK_BATCH)
+    comm.recv(source=dispatcher_rank, tag=HERE_IS_A_WORK_BATCH)
 
-            iterator = permutations(bucket, r=2)
 
+def worker(
+        mol_entries,
+        worker_payload
+):
+
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    sub_dispatcher_chunk_size, sub_dispatcher_block_size = comm.bcast(
+        None, root=DISPATCHER_RANK)
+
+    upstream_ranks = dispatch_tree(comm, sub_dispatcher_chunk_size is not None)
+    served_ranks = [
+        i for i in range(comm.Get_size()) if upstream_ranks[i] == rank]
+
+    if len(served_ranks) > 0:
+        sub_dispatcher(
+            comm,
+            served_ranks,
+            sub_dispatcher_chunk_size,
+            sub_dispatcher_block_size)
+        return
+
+    # the dispatcher, or this worker's sub-dispatcher
+    dispatcher_rank = upstream_ranks[rank]
+
+    reaction_decision_tree = worker_payload.reaction_decision_tree
+    logging_decision_tree = worker_payload.logging_decision_tree
+
+    if worker_payload.structural_memo:
+        skeletons = StructuralSkeletons(mol_entries)
+        reaction_decision_tree = memoize_structural_questions(
+            reaction_decision_tree, skeletons)
+        logging_decision_tree = memoize_structural_questions(
+            logging_decision_tree, skeletons)
+
+    shard_file = None
+    if worker_payload.reaction_shard_dir is not None:
+        os.makedirs(worker_payload.reaction_shard_dir, exist_ok=True)
+        shard_file = reaction_shard_path(
+            worker_payload.reaction_shard_dir,
+            rank)
+
+        if worker_payload.reaction_block_size is not None:
+            reaction_block = ReactionShard(
+                shard_file,
+                worker_payload.reaction_block_size)
         else:
+            reaction_block = ReactionShard(shard_file)
+
+    elif worker_payload.reaction_block_size is not None:
+        reaction_block = ReactionBlock(
+            comm,
+            worker_payload.reaction_block_size,
+            dispatcher_rank)
+    else:
+        reaction_block = None
 
-            res_0 = cur.execute(
-                get_complex_group_sql,
-                (composition_id, group_id_0))
+    if shard_file is not None:
+        shard_files = [shard_file]
+    else:
+        shard_files = []
 
-            bucket_0 = []
-            for row in res_0:
-                bucket_0.append((row[0],row[1]))
+    # the bucket database can be in any of the formats written by
+    # HiPRGen.bucketing, or a directory of bucket arrays
+    if worker_payload.prefetch:
+        work_batches = prefetched_work_batches(
+            comm,
+            dispatcher_rank,
+            worker_payload.bucket_db_file)
+    else:
+        work_batches = requested_work_batches(
+            comm,
+            dispatcher_rank,
+            open_group_loader(worker_payload.bucket_db_file))
 
-            res_1 = cur.execute(
-                get_complex_group_sql,
-                (composition_id, group_id_1))
+    comm.send(shard_files, dest=dispatcher_rank, tag=INITIALIZATION_FINISHED)
 
-            bucket_1 = []
-            for row in res_1:
-                bucket_1.append((row[0],row[1]))
+    for work_batch, loader in work_batches:
 
-            iterator = product(bucket_0, bucket_1)
+        for composition_id, group_id_0, group_id_1 in work_batch:
 
+            if group_id_0 == group_id_1:
 
+                bucket = loader.load(composition_id, group_id_0)
+                iterator = permutations(bucket, r=2)
 
-        for (reactants, products) in iterator:
-            reaction = {
-                'reactants' : reactants,
-                'products' : products,
-                'number_of_reactants' : len([i for i in reactants if i != -1]),
-                'number_of_products' : len([i for i in products if i != -1])}
+            else:
 
+                bucket_0 = loader.load(composition_id, group_id_0)
+                bucket_1 = loader.load(composition_id, group_id_1)
+                iterator = product(bucket_0, bucket_1)
 
-            decision_pathway = []
-            if run_decision_tree(reaction,
-                                 mol_entries,
-                                 worker_payload.params,
-                                 worker_payload.reaction_decision_tree,
-                                 decision_pathway
-                                 ):
 
-                comm.send(
-                    reaction,
-                    dest=DISPATCHER_RANK,
-                    tag=NEW_REACTION_DB)
 
+            for (reactants, products) in iterator:
+                reaction = candidate_reaction(reactants, products)
 
-            if run_decision_tree(reaction,
-                                 mol_entries,
-                                 worker_payload.params,
-                                 worker_payload.logging_decision_tree):
 
-                comm.send(
-                    (reaction,
-                     '\n'.join([str(f) for f in decision_pathway])
-                     ),
+                decision_pathway = []
+                if run_decision_tree(reaction,
+                                     mol_entries,
+                                     worker_payload.params,
+                                     reaction_decision_tree,
+                                     decision_pathway
+                                     ):
+
+                    if reaction_block is not None:
+                        reaction_block.add(reaction)
+                    else:
+                        comm.send(
+                            reaction,
+                            dest=dispatcher_rank,
+                            tag=NEW_REACTION_DB)
+
+
+                if run_decision_tree(reaction,
+                                     mol_entries,
+                                     worker_payload.params,
+                                     logging_decision_tree):
+
+                    comm.send(
+                        (reaction,
+                         '\n'.join([str(f) for f in decision_pathway])
+                         ),
+
+                        dest=dispatcher_rank,
+                        tag=NEW_REACTION_LOGGING)
+
+        # the reactions from a work batch are sent, or committed to the
+        # shard, before the worker asks for another work batch or, when
+        # prefetching, before its final request, so everything has been
+        # sent once the worker is done
+        if reaction_block is not None:
+            reaction_block.flush()
 
-                    dest=DISPATCHER_RANK,
-                    tag=NEW_REACTION_LOGGING)
+    if shard_file is not None:
+        reaction_block.close()
@@ -14,7 +14,12 @@ class DispatcherPayload(MSONable):
             reaction_network_db_file,
             report_file,
             commit_frequency = 1000,
-            checkpoint_interval = 10):
+            checkpoint_interval = 10,
+            max_charge_difference = None,
+            writer_block_size = None,
+            writer_queue_size = 16,
+            sub_dispatcher_chunk_size = None,
+            sub_dispatcher_block_size = 10000):
 
         self.bucket_db_file = bucket_db_file
         self.reaction_network_db_file = reaction_network_db_file
@@ -22,6 +27,25 @@ class DispatcherPayload(MSONable):
         self.commit_frequency = commit_frequency
         self.checkpoint_interval = checkpoint_interval
 
+        # only used with a bucket database written with charge groups.
+        # pairs of groups whose total charges differ by more than this
+        # are never dispatched.
+        self.max_charge_difference = max_charge_difference
+
+        # if not None, reactions are written to the reaction network
+        # database by a background thread, in blocks of this many rows,
+        # with at most writer_queue_size blocks waiting to be written.
+        # commit_frequency is ignored, each block is committed.
+        self.writer_block_size = writer_block_size
+        self.writer_queue_size = writer_queue_size
+
+        # if not None, one rank on each node is a sub-dispatcher for the
+        # workers on that node. Sub-dispatchers request this many work
+        # batches at a time from the dispatcher, and send the reactions
+        # from their workers on in blocks of sub_dispatcher_block_size.
+        self.sub_dispatcher_chunk_size = sub_dispatcher_chunk_size
+        self.sub_dispatcher_block_size = sub_dispatcher_block_size
+
 
 class WorkerPayload(MSONable):
     """
@@ -33,9 +57,33 @@ class WorkerPayload(MSONable):
             bucket_db_file,
             reaction_decision_tree,
             params,
-            logging_decision_tree):
+            logging_decision_tree,
+            structural_memo = False,
+            reaction_block_size = None,
+            reaction_shard_dir = None,
+            prefetch = False):
 
         self.bucket_db_file = bucket_db_file
         self.reaction_decision_tree = reaction_decision_tree
         self.params = params
         self.logging_decision_tree = logging_decision_tree
+
+        # if True, the worker memoizes the structural reaction
+        # questions by the skeletons of the reactants and products.
+        self.structural_memo = structural_memo
+
+        # if not None, reactions which pass the reaction decision tree
+        # are sent to the dispatcher in blocks of up to this many, at
+        # the end of each work batch or when the block is full.
+        self.reaction_block_size = reaction_block_size
+
+        # if not None, each worker writes the reactions which pass the
+        # reaction decision tree to its own shard database in this
+        # directory, in blocks of reaction_block_size if it is set, and
+        # the dispatcher merges the shards into the reaction network
+        # database once all the workers are finished.
+        self.reaction_shard_dir = reaction_shard_dir
+
+        # if True, the worker requests its next work batch and loads its
+        # groups on a helper thread while it runs the current one.
+        self.prefetch = prefetch
@@ -45,6 +45,11 @@ False. i.e getting stuck at a non terminal node is an error.
 Once a Terminal node is reached, it tells us whether to keep or
 discard the reaction.
 
+Questions which only depend on the covalent structure of the reactants
+and products have a class attribute structure_only = True, so that
+workers can memoize them (see HiPRGen.structural_memo). If they read
+the fragment data, they also have uses_fragment_data = True.
+
 logging decision tree: The dispatcher takes a second decision tree as
 an argument, the logging decision tree. Reactions which return
 Terminal.KEEP from the logging decision tree will be logged in the
@@ -59,6 +64,10 @@ hydrogen_hash = weisfeiler_lehman_graph_hash(
     hydrogen_graph,
     node_attr='specie')
 
+# id of hydrogen_hash when species_filter interns hashes. HashTable
+# always interns hydrogen_hash first.
+hydrogen_hash_id = 0
+
 
 def run_decision_tree(
         reaction,
@@ -334,6 +343,8 @@ class star_count_diff_above_threshold(MSONable):
     correct value for the threshold is 6.
     """
 
+    structure_only = True
+
     def __init__(self, threshold):
         self.threshold = threshold
 
@@ -376,6 +387,8 @@ class star_count_diff_above_threshold(MSONable):
             return False
 
 class reaction_is_covalent_decomposable(MSONable):
+    structure_only = True
+
     def __init__(self):
         pass
 
@@ -408,6 +421,8 @@ class reaction_is_covalent_decomposable(MSONable):
 
 
 class metal_coordination_passthrough(MSONable):
+    structure_only = True
+
     def __init__(self):
         pass
 
@@ -432,6 +447,9 @@ class metal_coordination_passthrough(MSONable):
 
 
 class fragment_matching_found(MSONable):
+    structure_only = True
+    uses_fragment_data = True
+
     def __init__(self):
         pass
 
@@ -558,7 +576,8 @@ class single_reactant_single_product_not_hydrogen_transfer(MSONable):
             reaction['number_of_products'] == 1 and
             len(reaction['reactant_bonds_broken']) == 1 and
             len(reaction['product_bonds_broken']) == 1 and
-            hydrogen_hash not in reaction['hashes']):
+            hydrogen_hash not in reaction['hashes'] and
+            hydrogen_hash_id not in reaction['hashes']):
 
             return True
 
@@ -587,6 +606,8 @@ class single_reactant_double_product_ring_close(MSONable):
 
 
 class concerted_metal_coordination(MSONable):
+    structure_only = True
+
     def __init__(self):
         pass
 
@@ -616,6 +637,8 @@ class concerted_metal_coordination(MSONable):
         return False
 
 class concerted_metal_coordination_one_product(MSONable):
+    structure_only = True
+
     def __init__(self):
         pass
 
@@ -648,6 +671,8 @@ class concerted_metal_coordination_one_product(MSONable):
         return False
 
 class concerted_metal_coordination_one_reactant(MSONable):
+    structure_only = True
+
     def __init__(self):
         pass
 
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from monty.json import MontyEncoder, MSONable
+
+"""
+on disk cache of mol entries for species filtering.
+
+Constructing a mol entry (building the molecule graph, computing hashes,
+star hashes and fragments) is the expensive part of species filtering.
+The cache stores each mol entry after it has been run through the
+species decision tree, keyed by a content hash of the dataset entry and
+the signatures of the species questions which modify mol entries (the
+ones with a version attribute). Questions which only filter are not part
+of the key, so changing them doesn't invalidate the cache.
+
+A cached mol entry may not have had every modifying question applied,
+because the tree can discard it before reaching them. For this reason,
+we store the positions of the modifying questions which were applied
+alongside the mol entry and only run the remaining ones on a cache hit.
+"""
+
+# increment this if MoleculeEntry construction changes
+cache_format_version = 1
+
+
+def mutating_questions(decision_tree):
+    """
+    the questions in decision_tree with a version attribute, in depth
+    first order.
+    """
+    questions = []
+
+    if type(decision_tree) == list:
+        for (question, node) in decision_tree:
+            if hasattr(question, 'version'):
+                questions.append(question)
+
+            questions.extend(mutating_questions(node))
+
+    return questions
+
+
+def question_signature(question):
+    if isinstance(question, MSONable):
+        description = question.as_dict()
+    else:
+        description = question.__module__ + '.' + question.__name__
+
+    return [description, question.version]
+
+
+def content_hash(*objects):
+    h = hashlib.sha256()
+    for obj in objects:
+        h.update(
+            json.dumps(obj, cls=MontyEncoder, sort_keys=True).encode())
+
+    return h.hexdigest()
+
+
+class CachedMutation:
+    """
+    wraps a species question which modifies the mol entry. The question
+    is skipped if the mol entry already had it applied, and otherwise
+    its position is recorded in applied.
+    """
+    def __init__(self, question, position, applied):
+        self.question = question
+        self.position = position
+        self.applied = applied
+
+    def __str__(self):
+        return str(self.question)
+
+    def __call__(self, mol):
+        if self.position in self.applied:
+            return False
+
+        result = self.question(mol)
+        self.applied.append(self.position)
+        return result
+
+
+class SpeciesCache:
+
+    def __init__(self, cache_dir, species_decision_tree):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.tree_signature = content_hash(
+            cache_format_version,
+            [question_signature(q)
+             for q in mutating_questions(species_decision_tree)])
+
+    def key(self, dataset_entry):
+        return content_hash(self.tree_signature, dataset_entry)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.pickle')
+
+    def load(self, key):
+        """
+        returns (mol_entry, applied) or None if key is not cached.
+        """
+        try:
+            with open(self.path(key), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def store(self, key, mol_entry, applied):
+        # write to a temporary file and then rename so that processes
+        # reading the cache never see a partially written entry
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((mol_entry, applied), f)
+
+        os.replace(temp_path, self.path(key))
+
+    def wrap_decision_tree(self, decision_tree, applied):
+        """
+        returns a copy of decision_tree where each modifying question is
+        wrapped in a CachedMutation sharing the applied list.
+        """
+        position = 0
+
+        def wrap(node):
+            nonlocal position
+            if type(node) != list:
+                return node
+
+            wrapped_node = []
+            for (question, new_node) in node:
+                if hasattr(question, 'version'):
+                    question = CachedMutation(question, position, applied)
+                    position += 1
+
+                wrapped_node.append((question, wrap(new_node)))
+
+            return wrapped_node
+
+        return wrap(decision_tree)
@@ -1,15 +1,21 @@
-from HiPRGen.mol_entry import MoleculeEntry
+from HiPRGen.mol_entry import MoleculeEntry, CompactMoleculeEntry
 from functools import partial
-from itertools import chain
+from itertools import chain, islice
+from collections import deque
+from contextlib import nullcontext
 from monty.serialization import dumpfn
 import pickle
-from HiPRGen.species_questions import run_decision_tree
+from HiPRGen.species_questions import run_decision_tree, DecisionTreeProfile
 from HiPRGen.constants import Terminal
 import networkx as nx
 from time import localtime, strftime
 from networkx.algorithms.graph_hashing import weisfeiler_lehman_graph_hash
 import networkx.algorithms.isomorphism as iso
-from HiPRGen.report_generator import ReportGenerator
+from HiPRGen.report_generator import ReportGenerator, visualize_molecule_entry
+from HiPRGen.species_cache import SpeciesCache
+from HiPRGen.species_store import write_species_store
+from HiPRGen.hash_table import HashTable, intern_hashes
+from multiprocessing import Pool
 """
 Phase 1: species filtering
 input: a list of dataset entries
@@ -70,6 +76,89 @@ def groupby(equivalence_relation, xs):
     return groups
 
 
+def covalent_certificate(mol):
+    """
+    isomorphism invariant of the covalent graph. Isomorphic covalent
+    graphs always have the same certificate, so two molecules with
+    different certificates can never be covalent isomorphic. The
+    converse is not true, so molecules sharing a certificate still need
+    to be compared using really_covalent_isomorphic.
+    """
+    graph = mol.covalent_graph
+    species = nx.get_node_attributes(graph, 'specie')
+
+    degree_sequence = tuple(sorted(
+        (species[n], d) for n, d in graph.degree()))
+
+    neighborhoods = tuple(sorted(
+        (species[n], tuple(sorted(species[m] for m in graph[n])))
+        for n in graph.nodes))
+
+    # the tag already contains the WL hash with the default 3 iterations.
+    # more iterations separate some graphs which collide at 3.
+    refined_hash = weisfeiler_lehman_graph_hash(
+        graph,
+        node_attr='specie',
+        iterations=6)
+
+    return (
+        graph.number_of_nodes(),
+        graph.number_of_edges(),
+        degree_sequence,
+        neighborhoods,
+        refined_hash)
+
+
+class CovalentIsomorphismGrouper:
+    """
+    groups molecules into covalent isomorphism classes. This has the
+    same output as groupby(really_covalent_isomorphic, mols), but
+    molecules are first looked up by covalent_certificate, so VF2 only
+    runs against the groups with the same certificate.
+
+    vf2_calls counts the isomorphism checks which were run and
+    vf2_calls_avoided counts the checks which groupby would have run on
+    top of those.
+    """
+    def __init__(self):
+        self.vf2_calls = 0
+        self.vf2_calls_avoided = 0
+
+    def group(self, mols):
+        if len(mols) == 1:
+            return [list(mols)]
+
+        groups = []
+        certificate_groups = {}
+
+        for mol in mols:
+            certificate = covalent_certificate(mol)
+            candidates = certificate_groups.setdefault(certificate, [])
+
+            group_index = None
+            vf2_calls = 0
+            for candidate_index in candidates:
+                vf2_calls += 1
+                if really_covalent_isomorphic(mol, groups[candidate_index][0]):
+                    group_index = candidate_index
+                    break
+
+            # groupby compares against every group created before the
+            # one which matches, or every group if nothing matches.
+            if group_index is None:
+                groupby_vf2_calls = len(groups)
+                candidates.append(len(groups))
+                groups.append([mol])
+            else:
+                groupby_vf2_calls = group_index + 1
+                groups[group_index].append(mol)
+
+            self.vf2_calls += vf2_calls
+            self.vf2_calls_avoided += groupby_vf2_calls - vf2_calls
+
+        return groups
+
+
 def log_message(string):
     print(
         '[' + strftime('%H:%M:%S', localtime()) + ']',
@@ -85,6 +174,124 @@ class Coordimer:
         self.ionization_energy = mol_entry.ionization_energy
         self.free_energy = mol_entry.free_energy
 
+def imap_bounded(pool, function, iterable, chunk_size, window_size):
+    """
+    like pool.imap, but iterable is consumed window_size items at a
+    time, with at most two windows in flight. pool.imap reads the whole
+    iterable into its task queue straight away, which defeats the point
+    of streaming the dataset entries.
+    """
+    iterator = iter(iterable)
+    pending = deque()
+
+    while True:
+        window = list(islice(iterator, window_size))
+        if len(window) > 0:
+            pending.append(pool.map_async(function, window, chunk_size))
+
+        if len(pending) == 0:
+            break
+
+        if len(pending) == 2 or len(window) == 0:
+            yield from pending.popleft().get()
+
+
+class SpeciesFilterTransfer:
+    """
+    builds the mol entry for a single dataset entry and runs it through
+    the species decision tree and the species logging decision tree.
+    This is a class rather than a closure so that it can be passed into
+    Pool(n).imap.
+    """
+    def __init__(
+            self,
+            species_decision_tree,
+            species_logging_decision_tree,
+            mol_pictures_folder=None,
+            species_cache=None,
+            profile=False):
+
+        self.species_decision_tree = species_decision_tree
+        self.species_logging_decision_tree = species_logging_decision_tree
+        self.mol_pictures_folder = mol_pictures_folder
+        self.species_cache = species_cache
+        self.profile = profile
+
+    def __call__(self, numbered_dataset_entry):
+        i, dataset_entry_bytes = numbered_dataset_entry
+        dataset_entry = pickle.loads(dataset_entry_bytes)
+
+        if self.species_cache is None:
+            mol = MoleculeEntry.from_dataset_entry(dataset_entry)
+            decision_tree = self.species_decision_tree
+        else:
+            key = self.species_cache.key(dataset_entry)
+
+            # cached mol entries have already been modified by the
+            # species questions, so we don't use them when drawing the
+            # unfiltered pictures.
+            cached = None
+            if self.mol_pictures_folder is None:
+                cached = self.species_cache.load(key)
+
+            if cached is None:
+                mol = MoleculeEntry.from_dataset_entry(dataset_entry)
+                applied = []
+            else:
+                mol, applied = cached
+
+            already_applied = len(applied)
+            decision_tree = self.species_cache.wrap_decision_tree(
+                self.species_decision_tree,
+                applied)
+
+        # the species questions modify the molecule graph, so the
+        # unfiltered pictures have to be drawn before running the tree
+        if self.mol_pictures_folder is not None:
+            visualize_molecule_entry(
+                mol,
+                self.mol_pictures_folder.joinpath(str(i) + ".pdf"))
+
+        # the profile for a single entry gets sent back with the result
+        # and merged in species_filter.
+        if self.profile:
+            profile = DecisionTreeProfile()
+        else:
+            profile = None
+
+        decision_pathway = []
+        keep = run_decision_tree(
+            mol,
+            decision_tree,
+            decision_pathway,
+            profile)
+
+        if (self.species_cache is not None and
+            (cached is None or len(applied) > already_applied)):
+            self.species_cache.store(key, mol, applied)
+
+        log = run_decision_tree(mol, self.species_logging_decision_tree)
+
+        # the mol entry is pickled here in both the serial and the
+        # parallel code paths. Pickle memoizes objects which are shared
+        # between mol entries, so if we only pickled in the parallel
+        # path, mol_entries.pickle would depend on the number of
+        # processes used. The same goes for the dataset entries going
+        # in, see numbered_dataset_entries in species_filter.
+        if keep or log:
+            mol_bytes = pickle.dumps(mol)
+        else:
+            mol_bytes = None
+
+        return (
+            mol.entry_id,
+            keep,
+            log,
+            '\n'.join([str(f) for f in decision_pathway]),
+            mol_bytes,
+            profile)
+
+
 def species_filter(
         dataset_entries,
         mol_entries_pickle_location,
@@ -93,25 +300,62 @@ def species_filter(
         coordimer_weight,
         species_logging_decision_tree=Terminal.DISCARD,
         generate_unfiltered_mol_pictures=False,
-        save_coordimers=False
+        save_coordimers=False,
+        num_threads=1,
+        chunk_size=8,
+        species_cache_dir=None,
+        compact_mol_entries_pickle_location=None,
+        species_store_location=None,
+        hash_table_location=None,
+        species_profile_location=None
 ):
 
     """
     run each molecule through the species decision tree and then choose the lowest weight
     coordimer based on the coordimer_weight function.
+
+    dataset_entries can be any iterable, for example
+    HiPRGen.dataset_reader.stream_dataset_entries. Entries are consumed
+    one at a time and only the mol entries which pass the species
+    decision tree (or get logged) are kept in memory.
+
+    if num_threads > 1, the mol entries are built and run through the
+    species decision tree by a process pool. The results are consumed
+    in input order, so the report and mol_entries.pickle are the same
+    as for the serial run.
+
+    if species_cache_dir is set, mol entries are loaded from and saved
+    to a SpeciesCache in that directory, so dataset entries which
+    haven't changed since the last run are not rebuilt.
+
+    if compact_mol_entries_pickle_location is set, the filtered species
+    are also pickled there as CompactMoleculeEntry objects. That pickle
+    is much smaller, and it is the one to pass to the reaction
+    filtering phase. mol_entries.pickle keeps the full mol entries for
+    analysis and drawing.
+
+    if species_store_location is set, the filtered species are also
+    written there as a memory mapped columnar store (see
+    HiPRGen.species_store), which can be used instead of either pickle
+    by the reaction filter and the network loader.
+
+    if hash_table_location is set, every hash stored on the filtered
+    species (total_hash, covalent_hash, star hashes, fragment hashes and
+    coordimer keys) is replaced by an int id and the HashTable mapping
+    ids back to hashes is saved there (see HiPRGen.hash_table).
+
+    if species_profile_location is set, the species decision tree is
+    profiled (see species_questions.DecisionTreeProfile) and a json
+    summary with the time spent in each question and how many mol
+    entries went through each edge is written there.
     """
 
     log_message("starting species filter")
-    log_message("loading molecule entries from json")
-
-    mol_entries_unfiltered = [
-        MoleculeEntry.from_dataset_entry(e) for e in dataset_entries ]
-
-
-    log_message("generating unfiltered mol pictures")
 
+    # the unfiltered mol pictures get drawn by SpeciesFilterTransfer,
+    # so we only use the report generator to create the folder.
     report_generator = ReportGenerator(
-        mol_entries_unfiltered,
+        [],
         species_report,
         mol_pictures_folder_name='mol_pictures_unfiltered',
         rebuild_mol_pictures=generate_unfiltered_mol_pictures
@@ -119,46 +363,102 @@ def species_filter(
 
     report_generator.emit_text("species report")
 
-    log_message("applying local filters")
+    if generate_unfiltered_mol_pictures:
+        mol_pictures_folder = report_generator.mol_pictures_folder
+    else:
+        mol_pictures_folder = None
+
+    if species_cache_dir is not None:
+        species_cache = SpeciesCache(species_cache_dir, species_decision_tree)
+    else:
+        species_cache = None
+
+    species_filter_transfer = SpeciesFilterTransfer(
+        species_decision_tree,
+        species_logging_decision_tree,
+        mol_pictures_folder,
+        species_cache,
+        profile=species_profile_location is not None)
+
+    species_profile = DecisionTreeProfile()
+
+    log_message("building molecule entries and applying local filters")
     mol_entries_filtered = []
 
     # note: it is important here that we are applying the local filters before
     # the non local ones. We remove some molecules which are lower energy
     # than other more realistic lithomers.
 
-    for i, mol in enumerate(mol_entries_unfiltered):
-        log_message("filtering " + mol.entry_id)
-        decision_pathway = []
-        if run_decision_tree(mol, species_decision_tree, decision_pathway):
-            mol_entries_filtered.append(mol)
+    # dataset entries reach the pool workers through pickle, which
+    # changes which objects are shared inside an entry. We pickle them
+    # in the serial path as well so that both paths build identical
+    # mol entries.
+    numbered_dataset_entries = (
+        (i, pickle.dumps(e)) for i, e in enumerate(dataset_entries))
+
+    if num_threads > 1:
+        pool = Pool(num_threads)
+    else:
+        pool = nullcontext()
+
+    with pool:
+        if num_threads > 1:
+            results = imap_bounded(
+                pool,
+                species_filter_transfer,
+                numbered_dataset_entries,
+                chunk_size,
+                num_threads * chunk_size * 4)
+        else:
+            results = map(species_filter_transfer, numbered_dataset_entries)
+
+        for i, (entry_id, keep, log, decision_pathway, mol_bytes,
+                entry_profile) in enumerate(results):
+
+            log_message("filtering " + entry_id)
 
-        if run_decision_tree(mol, species_logging_decision_tree):
+            if entry_profile is not None:
+                species_profile.merge(entry_profile)
 
-            report_generator.emit_verbatim(
-                '\n'.join([str(f) for f in decision_pathway]))
+            if mol_bytes is None:
+                continue
 
-            report_generator.emit_text("number: " + str(i))
-            report_generator.emit_text("entry id: " + mol.entry_id)
-            report_generator.emit_text("uncorrected free energy: " +
-                                       str(mol.free_energy))
+            mol = pickle.loads(mol_bytes)
 
-            report_generator.emit_text(
-                "number of coordination bonds: " +
-                str(mol.number_of_coordination_bonds))
+            if keep:
+                mol_entries_filtered.append(mol)
 
-            report_generator.emit_text(
-                "corrected free energy: " +
-                str(mol.solvation_free_energy))
+            if log:
 
-            report_generator.emit_text(
-                "formula: " + mol.formula)
+                report_generator.emit_verbatim(decision_pathway)
 
-            report_generator.emit_molecule(i, include_index=False)
-            report_generator.emit_newline()
+                report_generator.emit_text("number: " + str(i))
+                report_generator.emit_text("entry id: " + mol.entry_id)
+                report_generator.emit_text("uncorrected free energy: " +
+                                           str(mol.free_energy))
 
+                report_generator.emit_text(
+                    "number of coordination bonds: " +
+                    str(mol.number_of_coordination_bonds))
+
+                report_generator.emit_text(
+                    "corrected free energy: " +
+                    str(mol.solvation_free_energy))
+
+                report_generator.emit_text(
+                    "formula: " + mol.formula)
+
+                report_generator.emit_molecule(i, include_index=False)
+                report_generator.emit_newline()
 
     report_generator.finished()
 
+    if species_profile_location is not None:
+        log_message("writing species decision tree profile")
+        dumpfn(
+            species_profile.summary(species_decision_tree),
+            species_profile_location)
+
 
     # python doesn't have shared memory. That means that every worker during
     # reaction filtering must maintain its own copy of the molecules.
@@ -192,18 +492,33 @@ def species_filter(
 
 
     mol_entries = []
+    isomorphism_grouper = CovalentIsomorphismGrouper()
 
     for tag_group in sort_into_tags(mol_entries_filtered).values():
-        for iso_group in groupby(really_covalent_isomorphic, tag_group):
+        for iso_group in isomorphism_grouper.group(tag_group):
             mol_entries.append(
                 collapse_isomorphism_group(iso_group))
 
+    log_message(
+        "isomorphism grouping ran " +
+        str(isomorphism_grouper.vf2_calls) +
+        " VF2 checks and avoided " +
+        str(isomorphism_grouper.vf2_calls_avoided))
+
 
     log_message("assigning indices")
 
     for i, e in enumerate(mol_entries):
         e.ind = i
 
+    if hash_table_location is not None:
+        log_message("interning hashes")
+        hash_table = HashTable()
+        intern_hashes(mol_entries, hash_table)
+        hash_table.save(hash_table_location)
+        log_message(str(len(hash_table)) + " distinct hashes")
+    else:
+        hash_table = None
 
     log_message("creating molecule entry pickle")
     # ideally we would serialize mol_entries to a json
@@ -213,6 +528,20 @@ def species_filter(
     with open(mol_entries_pickle_location, 'wb') as f:
         pickle.dump(mol_entries, f)
 
+    if compact_mol_entries_pickle_location is not None:
+        log_message("creating compact molecule entry pickle")
+        with open(compact_mol_entries_pickle_location, 'wb') as f:
+            pickle.dump(
+                [CompactMoleculeEntry.from_mol_entry(m) for m in mol_entries],
+                f)
+
+    if species_store_location is not None:
+        log_message("creating species store")
+        write_species_store(
+            mol_entries,
+            species_store_location,
+            hash_table=hash_table)
+
     log_message("species filtering finished. " +
                 str(len(mol_entries)) +
                 " species")
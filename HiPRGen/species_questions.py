@@ -1,10 +1,10 @@
 from HiPRGen.mol_entry import MoleculeEntry, FragmentComplex
 import networkx as nx
 from networkx.algorithms.graph_hashing import weisfeiler_lehman_graph_hash
-import copy
 from functools import partial
 from HiPRGen.constants import li_ec, Terminal, mg_g2, mg_thf, m_formulas, metals
 import numpy as np
+from time import perf_counter
 from monty.json import MSONable
 
 """
@@ -12,7 +12,11 @@ species decision tree:
 
 A question is a function q(mol_entry) -> Bool
 
-Unlike for reaction filtering, these questions should not modify the mol_entry in any way.
+Some questions modify the mol_entry, for example by fixing bonds or by
+attaching hashes and fragments. These questions have a version
+attribute, which must be incremented whenever the data they compute
+changes. The versions are part of the species cache key, so bumping
+one invalidates the cached mol entries.
 
 A node is either a Terminal or a non empty list [(question, node)]
 
@@ -29,7 +33,14 @@ Once a Terminal node is reached, it tells us whether to keep or discard the spec
 
 def run_decision_tree(mol_entry,
                       decision_tree,
-                      decision_pathway=None):
+                      decision_pathway=None,
+                      profile=None):
+
+    if profile is not None:
+        return profile.run_decision_tree(
+            mol_entry,
+            decision_tree,
+            decision_pathway)
 
     node = decision_tree
 
@@ -65,6 +76,126 @@ def run_decision_tree(mol_entry,
         raise Exception("unexpected node type reached")
 
 
+def question_name(question):
+    if hasattr(question, '__name__'):
+        return question.__name__
+    else:
+        return type(question).__name__
+
+
+class DecisionTreeProfile:
+    """
+    per question statistics for a decision tree. Questions are
+    identified by their position in the tree, the indices of the edges
+    leading to them, so profiles collected from different copies of the
+    same tree (for example in a process pool) can be merged. For each
+    question we record the number of calls, the number of times it
+    answered True, the total time spent in it and the number of mol
+    entries which went through it and were then kept or discarded.
+
+    run_decision_tree only calls into the profile when one is passed,
+    so the normal path is unchanged.
+    """
+
+    def __init__(self):
+        self.stats = {}
+
+    def question_stats(self, position):
+        if position not in self.stats:
+            self.stats[position] = {
+                'calls': 0,
+                'true': 0,
+                'time': 0.0,
+                'keep': 0,
+                'discard': 0
+            }
+
+        return self.stats[position]
+
+    def run_decision_tree(self,
+                          mol_entry,
+                          decision_tree,
+                          decision_pathway=None):
+
+        node = decision_tree
+        position = ()
+        pathway_stats = []
+
+        while type(node) == list:
+            next_node = None
+            for index, (question, new_node) in enumerate(node):
+                stats = self.question_stats(position + (index,))
+
+                start = perf_counter()
+                answer = question(mol_entry)
+                stats['time'] += perf_counter() - start
+                stats['calls'] += 1
+
+                if answer:
+                    stats['true'] += 1
+                    pathway_stats.append(stats)
+
+                    if decision_pathway is not None:
+                        decision_pathway.append(question)
+
+                    position = position + (index,)
+                    next_node = new_node
+                    break
+
+            node = next_node
+
+        if type(node) == Terminal:
+            if decision_pathway is not None:
+                decision_pathway.append(node)
+
+            if node == Terminal.KEEP:
+                outcome = 'keep'
+            else:
+                outcome = 'discard'
+
+            for stats in pathway_stats:
+                stats[outcome] += 1
+
+            return node == Terminal.KEEP
+        else:
+            print(node)
+            raise Exception("unexpected node type reached")
+
+    def merge(self, other):
+        for position, other_stats in other.stats.items():
+            stats = self.question_stats(position)
+            for field, value in other_stats.items():
+                stats[field] += value
+
+    def summary(self, decision_tree):
+        """
+        a list with an entry for each question in decision_tree, in
+        depth first order.
+        """
+        summary = []
+
+        def walk(node, position):
+            if type(node) != list:
+                return
+
+            for index, (question, new_node) in enumerate(node):
+                question_position = position + (index,)
+                entry = {
+                    'position': list(question_position),
+                    'question': question_name(question)
+                }
+
+                if type(new_node) == Terminal:
+                    entry['terminal'] = new_node.name
+
+                entry.update(self.question_stats(question_position))
+                summary.append(entry)
+                walk(new_node, question_position)
+
+        walk(decision_tree, ())
+        return summary
+
+
 class metal_ion_filter(MSONable):
     "only allow positively charged metal ions"
     def __init__(self):
@@ -85,6 +216,8 @@ class mol_not_connected(MSONable):
 
 
 class add_star_hashes(MSONable):
+    version = 1
+
     def __init__(self):
         pass
 
@@ -104,6 +237,8 @@ class add_star_hashes(MSONable):
         return False
 
 class add_unbroken_fragment(MSONable):
+    version = 1
+
     def __init__(self):
         pass
 
@@ -121,7 +256,118 @@ class add_unbroken_fragment(MSONable):
 
         return False
 
+# weisfeiler lehman hashes of fragments, keyed by fragment_key. Lots of
+# molecules share fragments, so each process only hashes a fragment the
+# first time it sees it. The memo is cleared when it gets too big.
+fragment_hash_memo = {}
+fragment_hash_memo_size = 100000
+
+
+def fragment_key(graph, nodes, removed_edge=None):
+    """
+    describes the subgraph of graph induced by nodes, minus removed_edge
+    (a (u, v, key) triple). nodes are relabeled by their position in
+    the list, so equal keys mean isomorphic subgraphs.
+    """
+    position = {n: p for p, n in enumerate(nodes)}
+    edges = []
+
+    for u in nodes:
+        for v, keys in graph.adj[u].items():
+            if v in position and position[u] <= position[v]:
+                for k in keys:
+                    if (u, v, k) != removed_edge and (v, u, k) != removed_edge:
+                        edges.append((position[u], position[v]))
+
+    edges.sort()
+    return (tuple(graph.nodes[n]['specie'] for n in nodes), tuple(edges))
+
+
+def fragment_hash(graph, nodes, removed_edge=None):
+    key = fragment_key(graph, nodes, removed_edge)
+
+    if key not in fragment_hash_memo:
+        if len(fragment_hash_memo) >= fragment_hash_memo_size:
+            fragment_hash_memo.clear()
+
+        species, edges = key
+        fragment = nx.MultiGraph()
+        for p, specie in enumerate(species):
+            fragment.add_node(p, specie=specie)
+        fragment.add_edges_from(edges)
+
+        fragment_hash_memo[key] = weisfeiler_lehman_graph_hash(
+            fragment,
+            node_attr='specie')
+
+    return fragment_hash_memo[key]
+
+
+def bridge_sides(graph):
+    """
+    finds the bridges of a multigraph using a single depth first
+    search. Returns a dict mapping each bridge (u, v, key), in both
+    orientations, to the list of nodes below it in the search tree,
+    which is one of the two fragments left when the bridge is removed.
+    """
+    discovered = {}
+    low = {}
+    preorder = []
+    sides = {}
+
+    def neighbors(u):
+        return ((v, k) for v, keys in graph.adj[u].items() for k in keys)
+
+    for root in graph:
+        if root in discovered:
+            continue
+
+        discovered[root] = low[root] = len(preorder)
+        preorder.append(root)
+        stack = [(root, None, None, neighbors(root))]
+
+        while len(stack) > 0:
+            u, parent, parent_key, u_neighbors = stack[-1]
+
+            for v, k in u_neighbors:
+                if v == parent and k == parent_key:
+                    continue
+
+                if v in discovered:
+                    low[u] = min(low[u], discovered[v])
+                else:
+                    discovered[v] = low[v] = len(preorder)
+                    preorder.append(v)
+                    stack.append((v, u, k, neighbors(v)))
+                    break
+
+            else:
+                stack.pop()
+                if parent is not None:
+                    low[parent] = min(low[parent], low[u])
+
+                    # everything discovered since u is below u
+                    if low[u] > discovered[parent]:
+                        side = preorder[discovered[u]:]
+                        sides[(parent, u, parent_key)] = side
+                        sides[(u, parent, parent_key)] = side
+
+    return sides
+
+
 class add_single_bond_fragments(MSONable):
+    """
+    for each covalent bond, the fragments left when that bond is broken.
+    The fragments are in the order which connected_components would
+    list them after removing the bond.
+
+    The bridges of the covalent graph are found once. Breaking a bridge
+    splits its component in two, and the two sides come from the depth
+    first search. Breaking any other bond leaves the components as they
+    are, so only the component containing the bond is rehashed.
+    """
+
+    version = 1
 
     def __init__(self):
         pass
@@ -131,23 +377,42 @@ class add_single_bond_fragments(MSONable):
         if mol.formula in m_formulas:
             return False
 
+        graph = mol.covalent_graph
+        node_order = {n: p for p, n in enumerate(graph)}
 
+        components = [
+            sorted(c, key=node_order.get) for c in
+            nx.algorithms.components.connected_components(graph)]
 
-        for edge in mol.covalent_graph.edges:
-            fragments = []
-            h = copy.deepcopy(mol.covalent_graph)
-            h.remove_edge(*edge)
-            connected_components = nx.algorithms.components.connected_components(h)
-            for c in connected_components:
+        component_index = {}
+        for i, c in enumerate(components):
+            for n in c:
+                component_index[n] = i
 
-                subgraph = h.subgraph(c)
+        component_hashes = [fragment_hash(graph, c) for c in components]
+        sides = bridge_sides(graph)
 
-                fragment_hash = weisfeiler_lehman_graph_hash(
-                    subgraph,
-                    node_attr='specie')
+        for edge in graph.edges:
+            i = component_index[edge[0]]
 
+            if edge in sides:
+                side = set(sides[edge])
+                pieces = [
+                    [n for n in components[i] if n in side],
+                    [n for n in components[i] if n not in side]]
 
-                fragments.append(fragment_hash)
+                fragment_pieces = (
+                    [(c[0], h) for c, h in zip(components, component_hashes)
+                     if c is not components[i]] +
+                    [(piece[0], fragment_hash(graph, piece))
+                     for piece in pieces])
+
+                fragment_pieces.sort(key=lambda pair: node_order[pair[0]])
+                fragments = [h for _, h in fragment_pieces]
+
+            else:
+                fragments = list(component_hashes)
+                fragments[i] = fragment_hash(graph, components[i], edge)
 
             fragment_complex = FragmentComplex(
                 len(fragments),
@@ -159,7 +424,6 @@ class add_single_bond_fragments(MSONable):
 
         return False
 
-
 class metal_complex(MSONable):
     def __init__(self):
         pass
@@ -171,43 +435,71 @@ class metal_complex(MSONable):
 
         return not nx.is_connected(mol.covalent_graph)
 
-class li_fix_hydrogen_bonding(MSONable):
-    def __init__(self):
-        pass
+def squared_distances(mol):
+    """
+    matrix of squared distances between all pairs of atoms in mol.
+    """
+    locations = np.asarray(mol.atom_locations, dtype=np.float64)
+    displacements = locations[np.newaxis, :, :] - locations[:, np.newaxis, :]
+    return (displacements[:, :, 0] * displacements[:, :, 0] +
+            displacements[:, :, 1] * displacements[:, :, 1] +
+            displacements[:, :, 2] * displacements[:, :, 2])
 
-    def __call__(self, mol):
-        if mol.num_atoms > 1:
-            for i in range(mol.num_atoms):
-                if mol.species[i] == 'H':
 
-                    adjacent_atoms = []
+def adjacency_index(graph):
+    """
+    maps each node to the other end of every edge containing it, in the
+    order which graph.edges produces them (so multi edges are repeated).
+    """
+    adjacent = {n: [] for n in graph}
+    for bond in graph.edges:
+        adjacent[bond[0]].append(bond[1])
+        if bond[0] != bond[1]:
+            adjacent[bond[1]].append(bond[0])
 
-                    for bond in mol.graph.edges:
-                        if i in bond[0:2]:
+    return adjacent
 
-                            if i == bond[0]:
-                                adjacent_atom = bond[1]
-                            else:
-                                adjacent_atom = bond[0]
 
-                            displacement = (mol.atom_locations[adjacent_atom] -
-                                            mol.atom_locations[i])
+def negatively_charged(mol):
+    """
+    boolean array which is True for the atoms which have a negative
+    resp or mulliken partial charge.
+    """
+    return ((np.asarray(mol.partial_charges_resp) < 0) |
+            (np.asarray(mol.partial_charges_mulliken) < 0))
 
-                            dist = np.inner(displacement, displacement)
 
-                            adjacent_atoms.append((adjacent_atom, dist))
+class li_fix_hydrogen_bonding(MSONable):
+    version = 1
 
+    def __init__(self):
+        pass
 
-                    closest_atom, _ = min(adjacent_atoms, key=lambda pair: pair[1])
+    def __call__(self, mol):
+        if mol.num_atoms > 1:
+            distances = squared_distances(mol)
+            adjacent = adjacency_index(mol.graph)
+
+            for i in range(mol.num_atoms):
+                if mol.species[i] == 'H':
+
+                    adjacent_atoms = list(adjacent[i])
+                    closest_atom = min(
+                        adjacent_atoms,
+                        key=lambda j: distances[i, j])
 
-                    for adjacent_atom, _ in adjacent_atoms:
+                    for adjacent_atom in adjacent_atoms:
                         if adjacent_atom != closest_atom:
                             mol.graph.remove_edge(i, adjacent_atom)
                             mol.covalent_graph.remove_edge(i, adjacent_atom)
+                            adjacent[i].remove(adjacent_atom)
+                            adjacent[adjacent_atom].remove(i)
 
         return False
 
 class mg_fix_hydrogen_bonding(MSONable):
+    version = 1
+
     def __init__(self):
         pass
 
@@ -216,31 +508,19 @@ class mg_fix_hydrogen_bonding(MSONable):
         max_dist = 1.5
 
         if mol.num_atoms > 1:
+            distances = squared_distances(mol)
+            adjacent = adjacency_index(mol.graph)
+
             for i in range(mol.num_atoms):
                 if mol.species[i] == 'H':
 
-                    adjacent_atoms = []
-
-                    for bond in mol.graph.edges:
-                        if i in bond[0:2]:
-
-                            if i == bond[0]:
-                                adjacent_atom = bond[1]
-                            else:
-                                adjacent_atom = bond[0]
-
-                            displacement = (mol.atom_locations[adjacent_atom] -
-                                            mol.atom_locations[i])
-
-                            dist = np.inner(displacement, displacement)
-
-                            adjacent_atoms.append((adjacent_atom, dist))
-
-                    for adjacent_atom, dist in adjacent_atoms:
-                        if dist > max_dist ** 2:
+                    for adjacent_atom in list(adjacent[i]):
+                        if distances[i, adjacent_atom] > max_dist ** 2:
                             mol.graph.remove_edge(i, adjacent_atom)
                             if adjacent_atom in mol.covalent_graph:
                                 mol.covalent_graph.remove_edge(i, adjacent_atom)
+                            adjacent[i].remove(adjacent_atom)
+                            adjacent[adjacent_atom].remove(i)
 
         return False
 
@@ -271,6 +551,8 @@ class li_set_solvation_free_energy(MSONable):
     discard them if they are positively charged.
     """
 
+    version = 1
+
     def __init__(self, solvation_env):
         self.solvation_env = solvation_env
 
@@ -280,25 +562,22 @@ class li_set_solvation_free_energy(MSONable):
 
         correction = 0.0
 
+        if len(mol.m_inds) > 0:
+            distances = squared_distances(mol)
+            negative = negatively_charged(mol)
+
         for i in mol.m_inds:
 
             species = mol.species[i]
-            coordination_partners = []
             radius = self.solvation_env["coordination_radius"][species]
 
-            for j in range(mol.num_atoms):
-                if j != i:
-                    displacement_vector = (
-                        mol.atom_locations[j] -
-                        mol.atom_locations[i])
+            partners = (distances[i] < radius ** 2) & negative
+            partners[i] = False
+            coordination_partners = np.flatnonzero(partners).tolist()
 
-                    if (np.inner(displacement_vector, displacement_vector)
-                        < radius ** 2 and (
-                            mol.partial_charges_resp[j] < 0 or
-                            mol.partial_charges_mulliken[j] < 0)):
-                        if not mol.graph.has_edge(i,j):
-                            mol.graph.add_edge(i,j)
-                        coordination_partners.append(j)
+            for j in coordination_partners:
+                if not mol.graph.has_edge(i,j):
+                    mol.graph.add_edge(i,j)
 
 
             number_of_coordination_bonds = len(coordination_partners)
@@ -323,6 +602,8 @@ class mg_set_solvation_free_energy(MSONable):
     discard them if they are positively charged.
     """
 
+    version = 1
+
     def __init__(self, solvation_env):
         self.solvation_env = solvation_env
 
@@ -330,6 +611,10 @@ class mg_set_solvation_free_energy(MSONable):
         correction = 0.0
         mol.number_of_coordination_bonds = 0
 
+        if len(mol.m_inds) > 0:
+            distances = squared_distances(mol)
+            negative = negatively_charged(mol)
+
         for i in mol.m_inds:
 
             species = mol.species[i]
@@ -342,20 +627,12 @@ class mg_set_solvation_free_energy(MSONable):
                 effective_charge = "_2"
 
 
-            coordination_partners = list()
             species_charge = species + effective_charge
             radius = self.solvation_env["coordination_radius"][species_charge]
 
-            for j in range(mol.num_atoms):
-                if j != i:
-                    displacement_vector = (
-                        mol.atom_locations[j] -
-                        mol.atom_locations[i])
-                    if (np.inner(displacement_vector, displacement_vector)
-                        < radius ** 2 and (
-                            mol.partial_charges_resp[j] < 0 or
-                            mol.partial_charges_mulliken[j] < 0)):
-                        coordination_partners.append(j)
+            partners = (distances[i] < radius ** 2) & negative
+            partners[i] = False
+            coordination_partners = np.flatnonzero(partners).tolist()
 
             number_of_coordination_bonds = len(coordination_partners)
             mol.number_of_coordination_bonds += number_of_coordination_bonds
@@ -397,6 +674,8 @@ def compute_graph_hashes(mol):
 
     return False
 
+compute_graph_hashes.version = 1
+
 
 class li0_filter(MSONable):
     def __init__(self):
@@ -0,0 +1,313 @@
+import json
+import math
+import os
+from collections import OrderedDict
+import numpy as np
+from HiPRGen.mol_entry import CompactMoleculeEntry, FragmentComplex
+
+"""
+columnar species store.
+
+Every MPI rank used to unpickle its own copy of the filtered species.
+The species store writes them as a directory of .npy arrays instead,
+which readers open with np.load(mmap_mode='r'). All ranks on a node
+then share a single page cache copy of the arrays and startup is a few
+mmap calls.
+
+per species arrays (length number_of_species):
+    charge, spin_multiplicity, free_energy, solvation_free_energy,
+    electron_affinity, ionization_energy, total_hash, covalent_hash
+
+None is stored as nan for floats. Hashes are stored as ids into the
+hash table in strings.json.
+
+variable length data is stored in CSR format: the rows for species i
+are offsets[i]:offsets[i+1] of the data arrays.
+    species:           species_offsets, species_elements (element ids)
+    metal indices:     m_ind_offsets, m_inds
+    star hashes:       star_hash_offsets, star_hash_atoms, star_hash_ids
+    fragment data:     fragment_complex_offsets
+                       fragment_bonds_broken_count (per complex)
+                       fragment_bond_offsets, fragment_bonds (per complex)
+                       fragment_hash_offsets, fragment_hash_ids (per complex)
+
+strings.json holds the hash table, the element table, entry ids and
+formulas. Coordimers are not stored.
+
+If the species had their hashes interned by species_filter, the
+HashTable is stored as the hash table and the store hands out the
+interned ids rather than the hash strings.
+"""
+
+strings_file = 'strings.json'
+
+
+class StringInterner:
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def __call__(self, string):
+        if string not in self.ids:
+            self.ids[string] = len(self.strings)
+            self.strings.append(string)
+
+        return self.ids[string]
+
+
+def optional_float(x):
+    if x is None:
+        return math.nan
+    else:
+        return x
+
+
+def from_optional_float(x):
+    x = float(x)
+    if math.isnan(x):
+        return None
+    else:
+        return x
+
+
+def write_species_store(mol_entries, store_location, hash_table=None):
+
+    os.makedirs(store_location, exist_ok=True)
+
+    if hash_table is None:
+        hashes = StringInterner()
+        hash_strings = hashes.strings
+    else:
+        # the hashes on the mol entries are already ids into hash_table
+        def hashes(hash_id):
+            return hash_id
+        hash_strings = hash_table.hashes
+
+    elements = StringInterner()
+
+    columns = {
+        'charge': [],
+        'spin_multiplicity': [],
+        'free_energy': [],
+        'solvation_free_energy': [],
+        'electron_affinity': [],
+        'ionization_energy': [],
+        'total_hash': [],
+        'covalent_hash': [],
+        'species_offsets': [0],
+        'species_elements': [],
+        'm_ind_offsets': [0],
+        'm_inds': [],
+        'star_hash_offsets': [0],
+        'star_hash_atoms': [],
+        'star_hash_ids': [],
+        'fragment_complex_offsets': [0],
+        'fragment_bonds_broken_count': [],
+        'fragment_bond_offsets': [0],
+        'fragment_bonds': [],
+        'fragment_hash_offsets': [0],
+        'fragment_hash_ids': [],
+    }
+
+    for mol in mol_entries:
+        columns['charge'].append(mol.charge)
+        columns['spin_multiplicity'].append(mol.spin_multiplicity)
+        columns['free_energy'].append(optional_float(mol.free_energy))
+        columns['solvation_free_energy'].append(
+            optional_float(getattr(mol, 'solvation_free_energy', None)))
+        columns['electron_affinity'].append(
+            optional_float(mol.electron_affinity))
+        columns['ionization_energy'].append(
+            optional_float(mol.ionization_energy))
+
+        # species which never got their hashes computed get -1
+        for field in ['total_hash', 'covalent_hash']:
+            value = getattr(mol, field, None)
+            if value is None:
+                columns[field].append(-1)
+            else:
+                columns[field].append(hashes(value))
+
+        columns['species_elements'].extend(
+            [elements(s) for s in mol.species])
+        columns['species_offsets'].append(len(columns['species_elements']))
+
+        columns['m_inds'].extend(mol.m_inds)
+        columns['m_ind_offsets'].append(len(columns['m_inds']))
+
+        for atom, star_hash in mol.star_hashes.items():
+            columns['star_hash_atoms'].append(atom)
+            columns['star_hash_ids'].append(hashes(star_hash))
+        columns['star_hash_offsets'].append(len(columns['star_hash_ids']))
+
+        for fragment_complex in mol.fragment_data:
+            columns['fragment_bonds_broken_count'].append(
+                fragment_complex.number_of_bonds_broken)
+
+            for bond in fragment_complex.bonds_broken:
+                columns['fragment_bonds'].append(list(bond))
+            columns['fragment_bond_offsets'].append(
+                len(columns['fragment_bonds']))
+
+            for fragment_hash in fragment_complex.fragment_hashes:
+                columns['fragment_hash_ids'].append(hashes(fragment_hash))
+            columns['fragment_hash_offsets'].append(
+                len(columns['fragment_hash_ids']))
+
+        columns['fragment_complex_offsets'].append(
+            len(columns['fragment_bonds_broken_count']))
+
+    float_columns = [
+        'free_energy',
+        'solvation_free_energy',
+        'electron_affinity',
+        'ionization_energy']
+
+    offset_columns = [name for name in columns if name.endswith('_offsets')]
+
+    for name, values in columns.items():
+        if name in float_columns:
+            dtype = np.float64
+        elif name in offset_columns:
+            dtype = np.int64
+        else:
+            dtype = np.int32
+
+        array = np.array(values, dtype=dtype)
+        if name == 'fragment_bonds':
+            array = array.reshape((-1, 2))
+
+        np.save(os.path.join(store_location, name + '.npy'), array)
+
+    with open(os.path.join(store_location, strings_file), 'w') as f:
+        json.dump({
+            'hashes': hash_strings,
+            'interned': hash_table is not None,
+            'elements': elements.strings,
+            'entry_ids': [mol.entry_id for mol in mol_entries],
+            'formulas': [mol.formula for mol in mol_entries]
+        }, f)
+
+
+class SpeciesStore:
+    """
+    read only view of a species store. Indexing returns a
+    CompactMoleculeEntry, so a SpeciesStore can be used in place of the
+    mol_entries list by the reaction filter and the network loader.
+
+    Entries are built from the arrays when they are accessed, and the
+    cache_size most recently used entries are kept. The cache is
+    bounded so that a rank which touches every species doesn't end up
+    with its own copy of the whole species set next to the shared
+    arrays. Workers go through a composition at a time, so they mostly
+    hit the cache.
+    """
+
+    def __init__(self, store_location, cache_size=1024):
+        self.store_location = store_location
+        self.cache_size = cache_size
+
+        with open(os.path.join(store_location, strings_file), 'r') as f:
+            strings = json.load(f)
+
+        self.hashes = strings['hashes']
+        self.interned = strings.get('interned', False)
+        self.elements = strings['elements']
+        self.entry_ids = strings['entry_ids']
+        self.formulas = strings['formulas']
+
+        for name in os.listdir(store_location):
+            if name.endswith('.npy'):
+                setattr(
+                    self,
+                    name[:-len('.npy')],
+                    np.load(
+                        os.path.join(store_location, name),
+                        mmap_mode='r'))
+
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entry_ids)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def hash(self, hash_id):
+        if hash_id == -1:
+            return None
+        elif self.interned:
+            return int(hash_id)
+        else:
+            return self.hashes[hash_id]
+
+    def __getitem__(self, i):
+        if i in self.entries:
+            self.entries.move_to_end(i)
+            return self.entries[i]
+
+        if i < 0 or i >= len(self):
+            raise IndexError("species index out of range")
+
+        entry = self.build_entry(i)
+        self.entries[i] = entry
+        if len(self.entries) > self.cache_size:
+            self.entries.popitem(last=False)
+
+        return entry
+
+    def build_entry(self, i):
+
+        species = [
+            self.elements[e] for e in
+            self.species_elements[
+                self.species_offsets[i]:self.species_offsets[i+1]]]
+
+        m_inds = self.m_inds[
+            self.m_ind_offsets[i]:self.m_ind_offsets[i+1]].tolist()
+
+        star_hashes = {}
+        for k in range(self.star_hash_offsets[i], self.star_hash_offsets[i+1]):
+            star_hashes[int(self.star_hash_atoms[k])] = self.hash(
+                self.star_hash_ids[k])
+
+        fragment_data = []
+        for c in range(self.fragment_complex_offsets[i],
+                       self.fragment_complex_offsets[i+1]):
+
+            bonds_broken = [
+                tuple(bond) for bond in
+                self.fragment_bonds[
+                    self.fragment_bond_offsets[c]:
+                    self.fragment_bond_offsets[c+1]].tolist()]
+
+            fragment_hashes = [
+                self.hash(h) for h in
+                self.fragment_hash_ids[
+                    self.fragment_hash_offsets[c]:
+                    self.fragment_hash_offsets[c+1]]]
+
+            fragment_data.append(FragmentComplex(
+                len(fragment_hashes),
+                int(self.fragment_bonds_broken_count[c]),
+                bonds_broken,
+                fragment_hashes))
+
+        return CompactMoleculeEntry(
+            ind=i,
+            entry_id=self.entry_ids[i],
+            formula=self.formulas[i],
+            charge=int(self.charge[i]),
+            spin_multiplicity=int(self.spin_multiplicity[i]),
+            species=species,
+            m_inds=m_inds,
+            free_energy=from_optional_float(self.free_energy[i]),
+            solvation_free_energy=from_optional_float(
+                self.solvation_free_energy[i]),
+            electron_affinity=from_optional_float(self.electron_affinity[i]),
+            ionization_energy=from_optional_float(self.ionization_energy[i]),
+            total_hash=self.hash(self.total_hash[i]),
+            covalent_hash=self.hash(self.covalent_hash[i]),
+            star_hashes=star_hashes,
+            fragment_data=fragment_data)
@@ -0,0 +1,189 @@
+"""
+memoization of the structural reaction questions.
+
+Most of the candidate reactions in a composition come in families which
+only differ in the charges and spins of the reactants and products, and
+the expensive reaction questions (star counts, fragment matching,
+covalent decomposability, metal coordination) only look at the
+covalent structure, so they give the same answer for every member of a
+family. Those questions have a class attribute structure_only = True.
+
+The skeleton of a species is everything a structural question can read
+from it: the formula, the covalent hash and the star hashes. Species
+with the same skeleton get the same skeleton id, and the key of a
+candidate reaction is the skeleton ids of its reactants and products,
+in order.
+
+Questions which read the fragment data also set
+uses_fragment_data = True. Whether fragment_matching_found finds a
+match only depends on the fragment complexes of each species as a
+multiset, but when it does, it records the first match it finds in the
+reaction, including the atom indices of the broken bonds, and that
+depends on the order of the fragment complexes. So for these questions
+there are two skeletons: the fragment skeleton, which adds the fragment
+complexes without their broken bonds as a multiset, and the ordered
+fragment skeleton, which adds the fragment complexes as they are.
+
+memoize_structural_questions wraps each structural question in a
+decision tree with a StructuralMemo. A StructuralMemo stores the answer
+of its question along with the fields the question added to the
+reaction. Answers which didn't add any fields are stored by the key
+from the result skeletons and answers which did are stored by the key
+from the field skeletons, so structural questions must not change
+existing fields of the reaction, and whether they add fields must only
+depend on the result skeletons.
+"""
+
+
+def skeleton(mol):
+    return (
+        mol.formula,
+        mol.covalent_hash,
+        tuple(sorted(mol.star_hashes.values())))
+
+
+def fragment_skeleton(mol):
+    return skeleton(mol) + (
+        tuple(sorted([
+            (fragment_complex.number_of_fragments,
+             fragment_complex.number_of_bonds_broken,
+             tuple(sorted(fragment_complex.fragment_hashes)))
+            for fragment_complex in mol.fragment_data])),)
+
+
+def ordered_fragment_skeleton(mol):
+    return skeleton(mol) + (
+        tuple([
+            (fragment_complex.number_of_fragments,
+             fragment_complex.number_of_bonds_broken,
+             tuple([tuple(bond) for bond in fragment_complex.bonds_broken]),
+             tuple(fragment_complex.fragment_hashes))
+            for fragment_complex in mol.fragment_data]),)
+
+
+def skeleton_ids(mol_entries, skeleton_function=skeleton):
+    """
+    returns the skeleton id of each species, indexed by species id.
+    """
+    ids = {}
+    skeleton_id_list = [None] * len(mol_entries)
+
+    for mol in mol_entries:
+        mol_skeleton = skeleton_function(mol)
+        if mol_skeleton not in ids:
+            ids[mol_skeleton] = len(ids)
+
+        skeleton_id_list[mol.ind] = ids[mol_skeleton]
+
+    return skeleton_id_list
+
+
+def reaction_key(reaction, skeleton_id_list):
+    return (
+        tuple([skeleton_id_list[i] if i != -1 else -1
+               for i in reaction['reactants']]),
+        tuple([skeleton_id_list[i] if i != -1 else -1
+               for i in reaction['products']]))
+
+
+class StructuralMemo:
+
+    def __init__(
+            self,
+            question,
+            result_skeleton_id_list,
+            field_skeleton_id_list,
+            memo_size=100000):
+
+        self.question = question
+        self.result_skeleton_id_list = result_skeleton_id_list
+        self.field_skeleton_id_list = field_skeleton_id_list
+        self.memo_size = memo_size
+        self.result_memo = {}
+        self.field_memo = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __str__(self):
+        return str(self.question)
+
+    def __call__(self, reaction, mol_entries, params):
+        result_key = reaction_key(reaction, self.result_skeleton_id_list)
+
+        if result_key in self.result_memo:
+            self.hits += 1
+            return self.result_memo[result_key]
+
+        field_key = reaction_key(reaction, self.field_skeleton_id_list)
+
+        if field_key in self.field_memo:
+            self.hits += 1
+            result, fields = self.field_memo[field_key]
+            reaction.update(fields)
+            return result
+
+        self.misses += 1
+        existing_fields = set(reaction)
+        result = self.question(reaction, mol_entries, params)
+
+        fields = {
+            field: value for field, value in reaction.items()
+            if field not in existing_fields}
+
+        if len(fields) == 0:
+            memo = self.result_memo
+            memo_key = result_key
+            value = result
+        else:
+            memo = self.field_memo
+            memo_key = field_key
+            value = (result, fields)
+
+        if len(memo) == self.memo_size:
+            memo.clear()
+
+        memo[memo_key] = value
+        return result
+
+
+class StructuralSkeletons:
+    """
+    the skeleton ids of the species, for each kind of skeleton.
+    """
+    def __init__(self, mol_entries):
+        self.skeleton_id_list = skeleton_ids(mol_entries)
+        self.fragment_skeleton_id_list = skeleton_ids(
+            mol_entries, fragment_skeleton)
+        self.ordered_fragment_skeleton_id_list = skeleton_ids(
+            mol_entries, ordered_fragment_skeleton)
+
+    def memoize(self, question):
+        if getattr(question, 'uses_fragment_data', False):
+            return StructuralMemo(
+                question,
+                self.fragment_skeleton_id_list,
+                self.ordered_fragment_skeleton_id_list)
+        else:
+            return StructuralMemo(
+                question,
+                self.skeleton_id_list,
+                self.skeleton_id_list)
+
+
+def memoize_structural_questions(decision_tree, skeletons):
+    """
+    returns a copy of decision_tree where each structural question is
+    wrapped in a StructuralMemo. skeletons is a StructuralSkeletons.
+    """
+    if type(decision_tree) != list:
+        return decision_tree
+
+    memoized_tree = []
+    for (question, node) in decision_tree:
+        if getattr(question, 'structure_only', False):
+            question = skeletons.memoize(question)
+
+        memoized_tree.append(
+            (question, memoize_structural_questions(node, skeletons)))
+
+    return memoized_tree
@@ -0,0 +1,83 @@
+import os
+import sys
+import pickle
+from mpi4py import MPI
+
+from HiPRGen.species_store import SpeciesStore
+from HiPRGen.bucketing import (
+    write_bucket_shard,
+    merge_bucket_shards,
+    bucket_shard_path,
+    shard_species,
+    cost_balanced_group_size
+)
+
+
+# mpiexec -n N python run_bucketing.py mol_entries_pickle_file bucket_db [group_size] [options]
+# mol_entries_pickle_file can also be a species store directory
+# options are target_batch_cost=n, charge_groups and skeleton_order, as for
+# HiPRGen.bucketing.bucket
+# each rank writes a shard of the bucket database and rank 0 merges them
+
+
+comm = MPI.COMM_WORLD
+rank = comm.Get_rank()
+size = comm.Get_size()
+
+mol_entries_pickle_file = sys.argv[1]
+bucket_db = sys.argv[2]
+
+group_size = 1000
+target_batch_cost = None
+charge_groups = False
+skeleton_order = False
+
+for arg in sys.argv[3:]:
+    if arg.isdigit():
+        group_size = int(arg)
+    elif arg.startswith('target_batch_cost='):
+        target_batch_cost = int(arg[len('target_batch_cost='):])
+    elif arg == 'charge_groups':
+        charge_groups = True
+    elif arg == 'skeleton_order':
+        skeleton_order = True
+    else:
+        raise Exception("unknown option " + arg)
+
+if target_batch_cost is not None:
+    group_size = cost_balanced_group_size(target_batch_cost)
+
+if os.path.isdir(mol_entries_pickle_file):
+    mol_entries = SpeciesStore(mol_entries_pickle_file)
+else:
+    with open(mol_entries_pickle_file, 'rb') as f:
+        mol_entries = pickle.load(f)
+
+species, charges, skeletons = shard_species(
+    mol_entries,
+    charge_groups,
+    skeleton_order)
+
+shard_db = bucket_shard_path(bucket_db, rank)
+
+write_bucket_shard(
+    species,
+    shard_db,
+    rank,
+    size,
+    group_size,
+    charges=charges,
+    skeletons=skeletons)
+
+comm.Barrier()
+
+if rank == 0:
+    shard_dbs = [bucket_shard_path(bucket_db, shard) for shard in range(size)]
+    merge_bucket_shards(
+        bucket_db,
+        shard_dbs,
+        target_batch_cost,
+        charge_groups)
+
+    for shard_db in shard_dbs:
+        os.remove(shard_db)
@@ -0,0 +1,56 @@
+import os
+import sys
+import pickle
+from monty.serialization import loadfn, dumpfn
+
+from HiPRGen.species_store import SpeciesStore
+from HiPRGen.network_estimator import estimate_network
+
+
+# python run_estimator.py mol_entries_pickle_file dispatcher_payload.json worker_payload.json report.json [samples_per_composition]
+# takes the same arguments as run_network_generation.py, but runs on a
+# single process and writes a projection of the reaction filtering
+# run to report.json
+
+
+mol_entries_pickle_file = sys.argv[1]
+dispatcher_payload_json = sys.argv[2]
+worker_payload_json = sys.argv[3]
+report_json = sys.argv[4]
+
+if len(sys.argv) > 5:
+    samples_per_composition = int(sys.argv[5])
+else:
+    samples_per_composition = 100
+
+if os.path.isdir(mol_entries_pickle_file):
+    mol_entries = SpeciesStore(mol_entries_pickle_file)
+else:
+    with open(mol_entries_pickle_file, 'rb') as f:
+        mol_entries = pickle.load(f)
+
+report = estimate_network(
+    mol_entries,
+    loadfn(dispatcher_payload_json),
+    loadfn(worker_payload_json),
+    samples_per_composition)
+
+for field in [
+        'number_of_work_batches',
+        'candidate_reactions',
+        'sampled_reactions',
+        'sampled_passing',
+        'projected_reactions',
+        'projected_pass_rate',
+        'projected_cpu_seconds',
+        'bytes_per_reaction',
+        'projected_db_bytes']:
+    print(field + ':', report[field])
+
+worst_batch = report['worst_batch']
+if worst_batch is not None:
+    print('worst batch:', worst_batch['batch_index'],
+          worst_batch['candidate_reactions'], 'candidate reactions',
+          worst_batch['projected_seconds'], 'seconds')
+
+dumpfn(report, report_json)
@@ -1,8 +1,10 @@
+import os
 import sys
 import pickle
 from mpi4py import MPI
 from monty.serialization import loadfn
 
+from HiPRGen.species_store import SpeciesStore
 from HiPRGen.reaction_filter import (
     dispatcher,
     worker,
@@ -11,6 +13,7 @@ from HiPRGen.reaction_filter import (
 
 
 # python run_network_generation.py mol_entries_pickle_file dispatcher_payload.json worker_payload.json
+# mol_entries_pickle_file can also be a species store directory
 
 
 comm = MPI.COMM_WORLD
@@ -20,8 +23,11 @@ mol_entries_pickle_file = sys.argv[1]
 dispatcher_payload_json = sys.argv[2]
 worker_payload_json = sys.argv[3]
 
-with open(mol_entries_pickle_file, 'rb') as f:
-    mol_entries = pickle.load(f)
+if os.path.isdir(mol_entries_pickle_file):
+    mol_entries = SpeciesStore(mol_entries_pickle_file)
+else:
+    with open(mol_entries_pickle_file, 'rb') as f:
+        mol_entries = pickle.load(f)
 
 
 
@@ -6,8 +6,9 @@ import pickle
 
 
 from HiPRGen.network_loader import NetworkLoader
-from HiPRGen.initial_state import find_mol_entry_from_xyz_and_charge
-from monty.serialization import loadfn, dumpfn
+from HiPRGen.initial_state import SpeciesIndex
+from monty.serialization import dumpfn
+from HiPRGen.dataset_reader import stream_dataset_entries
 from HiPRGen.species_filter import species_filter
 from HiPRGen.bucketing import bucket
 from HiPRGen.report_generator import ReportGenerator
@@ -54,7 +55,10 @@ from HiPRGen.mc_analysis import (
 # time waiting for the dispatcher to get through all of the reactions it
 # is being sent, which slows everything down. Fixing this would require
 # a more complex distrubuted system, but it hasn't been an issue yet for
-# the large reaction networks we have been generating.
+# the large reaction networks we have been generating. Passing
+# reaction_shard_dir to the WorkerPayload takes the dispatcher out of
+# the way: each worker writes its reactions to its own shard, and the
+# dispatcher merges the shards at the end.
 if len(sys.argv) != 2:
     print("usage: python test.py number_of_threads")
     quit()
@@ -91,8 +95,11 @@ def li_test():
 
     # the initial input to the pipeline is a list of LIBE or MADEIRA
     # dataset entries. We provide two examples in the data foloder.
+    # stream_dataset_entries reads the entries one at a time (from a json
+    # array or json lines, optionally gzipped) rather than loading the
+    # whole dataset into memory.
     mol_json = './data/ronald_LIBE.json'
-    database_entries = loadfn(mol_json)
+    database_entries = stream_dataset_entries(mol_json)
     # the first step of the HiPRGen pipeline is passing the input molecules
     # through the a species decision tree to discard molecules. This happens
     # here rather than further complicating the DFT pipelines which generate the
@@ -107,21 +114,48 @@ def li_test():
     # defined in terms of a fixed molecule set, logging for the species
     # filtering phase is messy, so ignore the species_report argument for
     # now. The second argument is where we store a pickle of the
-    # filtered molecule entries for use in later phases.
+    # filtered molecule entries for use in later phases. Building the
+    # molecule entries and running them through the species decision tree
+    # can be spread over a process pool with num_threads. The output is
+    # identical to the serial run. hash_table_location makes the species
+    # carry small int ids instead of WL hash strings, which the reaction
+    # questions compare much faster. species_profile_location writes the
+    # time spent in each species question and how many molecules went
+    # down each edge of the species decision tree.
 
     mol_entries = species_filter(
         database_entries,
         mol_entries_pickle_location=folder + '/mol_entries.pickle',
         species_report=folder + '/unfiltered_species_report.tex',
         species_decision_tree=species_decision_tree,
-        coordimer_weight=lambda mol: mol.solvation_free_energy
+        coordimer_weight=lambda mol: mol.solvation_free_energy,
+        num_threads=int(number_of_threads),
+        compact_mol_entries_pickle_location=(
+            folder + '/compact_mol_entries.pickle'),
+        hash_table_location=folder + '/hash_table.json',
+        species_profile_location=folder + '/species_profile.json'
     )
 
 
     # once we have generated our molecule list, we generate the bucket database
     # which is how we break up the reaction filtering amoungst all avaliable workers.
-    # it gets stored in the buckets.sqlite database.
-    bucket(mol_entries, folder + '/buckets.sqlite')
+    # it gets stored in the buckets.sqlite database. bulk=True inserts the
+    # rows in large batches and only builds the index at the end.
+    # HiPRGen.bucketing.virtual_bucket can be used instead. It doesn't
+    # store the pairs of species, and the workers enumerate them from
+    # the composition of each species. For large species sets,
+    # HiPRGen.bucketing.parallel_bucket or run_bucketing.py under mpiexec
+    # write the bucket database in shards and merge them.
+    # bucket(..., target_batch_cost=n) sizes the work batches so that each
+    # has at most about n candidate reactions, instead of using fixed
+    # size groups. bucket(..., charge_groups=True) together with
+    # DispatcherPayload(..., max_charge_difference=1) skips pairs of groups
+    # whose reactions would all be discarded by dcharge_too_large.
+    # HiPRGen.bucketing.write_bucket_arrays exports the groups to a
+    # directory of memory mapped arrays. Passing that directory as the
+    # bucket database in the WorkerPayload makes the workers read their
+    # groups from it instead of querying sqlite.
+    bucket(mol_entries, folder + '/buckets.sqlite', bulk=True)
 
 
     # reaction filtering is paralellized using MPI, so we need to spawn
@@ -143,17 +177,36 @@ def li_test():
         'electron_free_energy' : -1.4
     }
 
+    # writer_block_size=n makes the dispatcher write the reaction network
+    # database from a background thread, in blocks of n reactions, so
+    # that it keeps answering the workers while sqlite is busy.
+    # sub_dispatcher_chunk_size=n puts a sub-dispatcher on each node,
+    # which requests n work batches at a time from the dispatcher and
+    # collects the reactions from the workers on its node into blocks.
     dispatcher_payload = DispatcherPayload(
         folder + '/buckets.sqlite',
         folder + '/rn.sqlite',
         folder + '/reaction_report.tex'
     )
 
+    # reaction_block_size=n makes the workers send the reactions which
+    # pass the reaction decision tree to the dispatcher in binary blocks
+    # of up to n reactions rather than one message per reaction.
+    # reaction_shard_dir=directory makes each worker write those
+    # reactions to its own sqlite shard in directory instead, which the
+    # dispatcher merges into the reaction network database at the end.
+    # prefetch=True makes each worker request its next work batch and
+    # load its groups while it is still running the current one.
+    # structural_memo=True makes the workers evaluate the structural
+    # reaction questions once for each pair of covalent skeletons. It
+    # works best with bucket(..., skeleton_order=True), which puts the
+    # charge and spin variants of a complex into the same groups.
     worker_payload = WorkerPayload(
         folder + '/buckets.sqlite',
         li_ec_reaction_decision_tree,
         params,
-        Terminal.DISCARD
+        Terminal.DISCARD,
+        structural_memo=True
     )
 
 
@@ -162,6 +215,13 @@ def li_test():
     dumpfn(dispatcher_payload, folder + '/dispatcher_payload.json')
     dumpfn(worker_payload, folder + '/worker_payload.json')
 
+    # before a large run, run_estimator.py takes the same arguments as
+    # run_network_generation.py (plus an output json) and projects the
+    # number of reactions, CPU time and rn.sqlite size from a sample.
+
+    # every MPI rank loads its own copy of the species, so we pass it the
+    # compact species pickle, which only contains the data that the
+    # reaction questions need.
     subprocess.run(
         [
             'mpiexec',
@@ -170,28 +230,29 @@ def li_test():
             number_of_threads,
             'python',
             'run_network_generation.py',
-            folder + '/mol_entries.pickle',
+            folder + '/compact_mol_entries.pickle',
             folder + '/dispatcher_payload.json',
             folder + '/worker_payload.json'
         ]
     )
 
     # after we have generated the mol_entries, we refer to molecules by
-    # their index. The function find_mol_entry_from_xyz_and_charge is able
-    # to find a mol entry just from the xyz positions of its atoms, although
-    # it isn't 100% reliable.
-    Li_plus_id = find_mol_entry_from_xyz_and_charge(
-        mol_entries,
+    # their index. A SpeciesIndex is able to find a mol entry just from
+    # the xyz positions of its atoms, although it isn't 100% reliable.
+    # It returns None if a molecule isn't found. There is also
+    # species_index.find_by_xyz_directory, which looks up every xyz file
+    # in a directory at once.
+    species_index = SpeciesIndex(mol_entries)
+
+    Li_plus_id = species_index.find_by_xyz_and_charge(
         './xyz_files/Li.xyz',
         1)
 
-    EC_id = find_mol_entry_from_xyz_and_charge(
-        mol_entries,
+    EC_id = species_index.find_by_xyz_and_charge(
         './xyz_files/EC.xyz',
         0)
 
-    LEDC_id = find_mol_entry_from_xyz_and_charge(
-        mol_entries,
+    LEDC_id = species_index.find_by_xyz_and_charge(
         './xyz_files/LEDC.xyz',
         0)
 
@@ -322,7 +383,7 @@ def mg_test():
     mol_json = './data/sam_G2.json'
     species_decision_tree = mg_g2_species_decision_tree
 
-    database_entries = loadfn(mol_json)
+    database_entries = stream_dataset_entries(mol_json)
     mol_entries = species_filter(
         database_entries,
         folder + '/mol_entries.pickle',
@@ -369,18 +430,17 @@ def mg_test():
     )
 
 
-    mg_g2_plus_plus_id = find_mol_entry_from_xyz_and_charge(
-        mol_entries,
+    species_index = SpeciesIndex(mol_entries)
+
+    mg_g2_plus_plus_id = species_index.find_by_xyz_and_charge(
         './xyz_files/mgg2.xyz',
         2)
 
-    c2h4_id = find_mol_entry_from_xyz_and_charge(
-        mol_entries,
+    c2h4_id = species_index.find_by_xyz_and_charge(
         './xyz_files/c2h4.xyz',
         0)
 
-    c2h6_id = find_mol_entry_from_xyz_and_charge(
-        mol_entries,
+    c2h6_id = species_index.find_by_xyz_and_charge(
         './xyz_files/c2h6.xyz',
         0)
 